@@ -6,36 +6,26 @@
     3. schedule a refresh for corresponding view(s)
 
 Filename of this module starts with 0_ because we want it being loaded before other FileBrowser
-modules, so we can check if auto-refresh is functional.
-The reason why we cannot check functionality here, but have to in the other module, is because
-dired.py module is refreshing existing views on start-up, thus before checking presence of
-auto-refresh, we must be sure that Refresh command is functional (i.e. dired.py is loaded).
-In the other words, the algorithm is after we sure that
-    1) all views are loaded (see dired.plugin_loaded),
-    2) auto-refresh is presented,
-then, finally,
-    3) we add callback on change of dired_autorefresh setting (so user can disable it globally).
-That is why this module must be loaded first, but its presence is checked in the other module.
+modules, so channel listeners exist before dired.py refreshes existing views on start-up.
+
+watchdog is imported and observer thread is started only when the first FileBrowser view registers
+paths (i.e. finish refresh), and observer thread is stopped IDLE_SHUTDOWN after the last view is
+closed; ObservePaths and ReportEvent stay alive (with their settings, stats, etc.), so next start
+only creates new observer thread. If watchdog is not importable, user is notified once per session.
 '''
 
 from __future__ import print_function
-import sublime, os, datetime
+import sublime, os, re, time, threading
+from collections import deque
 
-try:  # unavailable dependencies shall not break basic functionality
-    import package_events
-    from watchdog.observers import Observer
-    from watchdog.events import FileSystemEventHandler, DirModifiedEvent
-except ImportError:
-    Observer = None
-    FileSystemEventHandler = object
+Observer = None  # watchdog.observers.Observer, see import_watchdog
 
 ST3 = int(sublime.version()) >= 3000
 
 if ST3:
-    from functools import reduce
-    from .common import emit_event
+    from .common import emit_event, refresh_views, channel, NT
 else:  # ST2 imports
-    from common import emit_event
+    from common import emit_event, refresh_views, channel, NT
 
 
 def plugin_loaded():
@@ -49,55 +39,155 @@ def plugin_unloaded():
         print('\nShutting down observer:', observer)
     else:
         return
-    if observer is not None:
-        observer.observer.stop()
-        package_events.unlisten(u'FileBrowser', observer.dired_event_handler)
-        package_events.unlisten(u'FileBrowserWFS', observer.event_handler.update_paths)
-        observer.observer.join()
+    observer.event_handler.settings.clear_on_change('dired_autorefresh_ignore_patterns')
+    channel.unlisten(u'FileBrowser', observer.dired_event_handler)
+    channel.unlisten(u'FileBrowserWFS', observer.event_handler.update_paths)
+    observer.stop(join=True)
     del observer
     print('BOOM!!1 done...\n')
 
 
-REFRESH_TIMEOUT  = 1000  # milliseconds: auto-refresh shall not happen more than once per REFRESH_TIMEOUT
-SCHEDULE_REFRESH = 700   # milliseconds: time out for checking REFRESH_TIMEOUT
-
-
-def time_out(past, now):
-    return (now - past) > datetime.timedelta(milliseconds=REFRESH_TIMEOUT)
-
-
-def refresh(views, erase_settings=False):
+def import_watchdog():
+    '''Return True if watchdog is importable; import is postponed until it is really needed,
+    unavailable dependencies shall not break basic functionality'''
+    global Observer
+    if Observer is None:
+        try:
+            from watchdog.observers import Observer
+        except ImportError:
+            return False
+    return True
+
+
+def report_missing_watchdog():
+    sublime.error_message(
+        u'FileBrowser:\n\n'
+        u'watchdog module is not importable, hence we cannot know about '
+        u'changes on file system, and auto-refresh will not work.\n\n'
+        u'Despite that, FileBrowser is fully usable without auto-refresh, '
+        u'you can just ignore this message and manually refresh view with r key.\n\n'
+        u'But if you want working auto-refresh:\n'
+        u' • if you install manually, then look at Readme how to install it,\n'
+        u' • if you install via Package Control, report an issue.')
+
+
+REFRESH_TIMEOUT  = 1000   # milliseconds: auto-refresh shall not happen more than once per REFRESH_TIMEOUT
+SCHEDULE_REFRESH = 700    # milliseconds: time out for checking REFRESH_TIMEOUT
+IDLE_SHUTDOWN    = 5000   # milliseconds: stop observer thread if nothing is watched that long
+COST_RATIO       = 4      # interval between auto-refreshes is at least COST_RATIO times longer than refresh
+RATE_WINDOW      = 5000   # milliseconds: only events within this window count for rate of events
+STORM_RATE       = 20     # events per second: more frequent events put view in storm mode
+STORM_INTERVAL   = 10000  # milliseconds: if interval grows wider than that, view is in storm mode
+QUIESCENCE       = 2000   # milliseconds: in storm mode view is refreshed only after that long silence
+
+
+def refresh(views, erase_settings=False, args=None):
     '''
     views
         list of integers which are view.id(), can be empty
     erase_settings
         boolean, can be True after change of global setting dired_autorefresh
+    args
+        dict, arguments for dired_refresh command
     '''
     if not views and not erase_settings:
         def is_dired(view): return view.settings() and view.settings().get("dired_path")
     else:
         def is_dired(view): return False
 
+    dired_views = []
     for w in sublime.windows():
         for v in w.views():
             if v.id() in views or is_dired(v):
                 if erase_settings:
                     v.settings().erase('dired_autorefresh')
-                v.run_command('dired_refresh')
+                v.settings().erase('dired_autorefresh_storm')
+                dired_views.append(v)
+    refresh_views(dired_views, args)
 
 
-class ObservePaths(object):
-    def __new__(cls):
-        if Observer is None:
-            return None
-        return object.__new__(cls)
+def show_storm(views):
+    '''views is list of integers (view.id()) which enter storm mode'''
+    for w in sublime.windows():
+        for v in w.views():
+            if v.id() in views:
+                v.settings().set('dired_autorefresh_storm', True)
+                v.run_command('dired_update_status')
+
+
+def compile_patterns(patterns, basename_only=False):
+    '''Return compiled regex for list of fnmatch-like patterns or None if list is empty
+    patterns
+        e.g. [".git", "__pycache__", "node_modules/.cache"]; wildcards * and ? never match
+        path separator, so pattern with slash matches sequence of path components
+    basename_only
+        if True, regex matches only last component of path (i.e. name of file or directory),
+        otherwise it matches any component (or sequence of components) of path
+    Regex is supposed to be applied to path with forward slashes relative to directory of view, see
+    ReportEvent.is_ignored
+    '''
+    if isinstance(patterns, str if ST3 else basestring):
+        patterns = [patterns]
+    translated = []
+    for pattern in patterns or []:
+        pattern = pattern.replace('\\', '/').strip('/')
+        if not pattern:
+            continue
+        parts = []
+        for c in pattern:
+            if c == '*':
+                parts.append('[^/]*')
+            elif c == '?':
+                parts.append('[^/]')
+            else:
+                parts.append(re.escape(c))
+        translated.append(''.join(parts))
+    if not translated:
+        return None
+    regex = u'(?:^|/)(?:%s)%s' % ('|'.join(translated), '$' if basename_only else '(?:/|$)')
+    return re.compile(regex, re.IGNORECASE if NT else 0)
 
+
+def normalize(path):
+    return path.replace('\\', '/') if NT else path
+
+
+class ObservePaths(object):
     def __init__(self):
-        self.observer = Observer()
+        self.observer = None  # watchdog Observer, exists only while there is sth to watch
+        self.unavailable = False  # True if watchdog is not importable
         self.event_handler = ReportEvent()
         self.paths = {}
+        self.watches = {}  # path: ObservedWatch
+        channel.listen(u'FileBrowser', self.dired_event_handler)
+
+    def start(self):
+        '''Return True if observer thread is running, start it if needed'''
+        if self.observer is not None:
+            return True
+        if self.unavailable:
+            return False
+        if not import_watchdog():
+            self.unavailable = True
+            sublime.set_timeout(report_missing_watchdog, 1)
+            return False
+        self.observer = Observer()
         self.observer.start()
-        package_events.listen(u'FileBrowser', self.dired_event_handler)
+        return True
+
+    def stop(self, join=False):
+        '''Stop observer thread, watched paths are kept so it can be started again'''
+        if self.observer is None:
+            return
+        self.observer.stop()
+        if join:
+            self.observer.join()
+        self.observer = None
+        self.watches = {}
+
+    def stop_if_idle(self):
+        if not self.watches:
+            self.stop()
 
     def dired_event_handler(self, package, event, payload):
         '''receiving args from common.emit_event'''
@@ -118,17 +208,13 @@ class ObservePaths(object):
             self.paths.update({view: sorted(p for p in
                               set(old_paths + [p.rstrip(os.sep) for p in paths])
                               if os.path.exists(p))})
-            self.observer.unschedule_all()
-            for p in reduce(lambda i, j: i + j, self.paths.values()):
-                self.observer.schedule(self.event_handler, p)
 
         def fold(view, path):
-            p = set(self.paths.get(view, [])) - set([path.rstrip(os.sep)])
-            finish_refresh(view, list(p))
+            self.paths.update({view: sorted(set(self.paths.get(view, [])) - set([path.rstrip(os.sep)]))})
 
         def toggle_watch_all(watch):
             '''watch is boolean or None, global setting dired_autorefresh'''
-            views = self.paths.keys()
+            views = list(self.paths.keys())
             if not watch:
                 self.paths = {}
             sublime.set_timeout(lambda: refresh(views, erase_settings=(not watch)), 1)
@@ -141,33 +227,185 @@ class ObservePaths(object):
             'stop_watch': lambda: view_closed(payload),
             'toggle_watch_all': lambda: toggle_watch_all(payload)
         }
+        before = dict(self.paths)
         case[event]()
-        emit_event(u'', self.paths, plugin=u'FileBrowserWFS')
-
-
-class ReportEvent(FileSystemEventHandler):
+        # send only deltas, lists are never modified in place so comparison is reliable
+        for view in set(before) | set(self.paths):
+            paths = self.paths.get(view)
+            if before.get(view) != paths:
+                emit_event(u'paths', (view, tuple(paths or [])), plugin=u'FileBrowserWFS')
+        if event != 'start_refresh':  # finish_refresh follows soon, so watches will be synced then
+            self.sync_watches()
+
+    def sync_watches(self):
+        '''Schedule new paths and unschedule paths which are not in any view anymore'''
+        paths = set(p for view_paths in self.paths.values() for p in view_paths)
+        if not paths:
+            if self.observer is not None:
+                self.unschedule(list(self.watches))
+                sublime.set_timeout(self.stop_if_idle, IDLE_SHUTDOWN)
+            return
+        if not self.start():
+            return
+        self.unschedule(set(self.watches) - paths)
+        for p in paths - set(self.watches):
+            try:
+                self.watches[p] = self.observer.schedule(self.event_handler, p)
+            except OSError as e:
+                print('FileBrowser: cannot watch %s: %s' % (p, e))
+
+    def unschedule(self, paths):
+        for p in paths:
+            try:
+                self.observer.unschedule(self.watches.pop(p))
+            except KeyError:  # watch was removed by watchdog, e.g. directory was deleted
+                pass
+
+
+class RefreshStats(object):
+    '''Per view measurements for adaptive scheduling of auto-refresh, all times are in seconds
+        cost            duration of last refresh
+        last_refresh    when last refresh was finished
+        pending_since   when first event after last refresh was received, 0 if none
+        last_event      when last event was received
+        events          times of recent events, for rate of events
+        storm           boolean, if True view is refreshed only on quiescence
+    add_event is called on watchdog thread, other methods on main thread, so events are guarded
+    by lock
+    '''
     def __init__(self):
-        self.paths = {}
-        self.ignore_views = set()
-        self.scheduled_views = {}
-        package_events.listen(u'FileBrowserWFS', self.update_paths)
+        self.cost = self.last_refresh = self.pending_since = self.last_event = 0
+        self.events = deque()
+        self.storm = False
+        self.lock = threading.Lock()
+
+    def add_event(self, now):
+        self.last_event = now
+        if not self.pending_since:
+            self.pending_since = now
+        with self.lock:
+            self.events.append(now)
+            while self.events and now - self.events[0] > RATE_WINDOW / 1000.0:
+                self.events.popleft()
+
+    def finish_refresh(self, cost):
+        self.cost = cost
+        self.last_refresh = time.time()
+        self.pending_since = 0
+
+    def rate(self, now):
+        '''events per second within RATE_WINDOW'''
+        with self.lock:
+            events = list(self.events)
+        return len([t for t in events if now - t <= RATE_WINDOW / 1000.0]) / (RATE_WINDOW / 1000.0)
+
+    def interval(self, now):
+        '''minimum time between auto-refreshes, grows with cost of refresh and rate of events'''
+        return max(REFRESH_TIMEOUT / 1000.0, COST_RATIO * self.cost * (1 + self.rate(now)))
+
+    def due(self, now):
+        '''Return True if view shall be refreshed now, update storm mode'''
+        interval = self.interval(now)
+        if not self.storm:
+            self.storm = self.rate(now) >= STORM_RATE or interval >= STORM_INTERVAL / 1000.0
+        if self.storm:
+            return now - self.last_event >= QUIESCENCE / 1000.0
+        if now - self.last_refresh < interval:
+            return False
+        # debounce, but do not postpone refresh more than interval during steady flow of events
+        return (now - self.last_event >= REFRESH_TIMEOUT / 1000.0 or
+                now - self.pending_since >= interval)
+
+
+class ReportEvent(object):
+    '''Event handler for watchdog, it does not inherit FileSystemEventHandler, so watchdog is not
+    imported until observer is started, see ObservePaths.start'''
+    def __init__(self):
+        self.paths = {}  # view id: frozenset of watched paths
+        self.roots = {}  # view id: directory of view, the shortest watched path
+        self.ignore_views = frozenset()
+        self.scheduled_views = set()
+        self.stats = {}  # view id: RefreshStats
+        self.scheduling = False
+        self.lock = threading.Lock()  # guards scheduled_views and scheduling, see on_any_event
+        self.hidden = {}  # view id: regex for hidden files, only for views which do not show them
+        self.settings = sublime.load_settings('dired.sublime-settings')
+        self.set_ignore_patterns()
+        self.settings.add_on_change('dired_autorefresh_ignore_patterns', self.set_ignore_patterns)
+        channel.listen(u'FileBrowserWFS', self.update_paths)
+
+    def set_ignore_patterns(self):
+        '''callback for global setting dired_autorefresh_ignore_patterns'''
+        self.ignore = compile_patterns(self.settings.get('dired_autorefresh_ignore_patterns', []))
 
     def update_paths(self, package, event, payload):
+        '''receiving args from common.emit_event, called on main thread
+        self.paths, self.ignore_views and self.hidden are replaced rather than modified (copy on write),
+        so on_any_event (watchdog thread) always sees consistent snapshot
+        '''
         if event == u'ignore_view':
-            self.ignore_views.update([payload])
+            self.ignore_views = self.ignore_views | frozenset([payload])
             return
         elif event == u'watch_view':
-            self.ignore_views -= set([payload])
+            self.ignore_views = self.ignore_views - frozenset([payload])
+            return
+        elif event == u'hidden_patterns':
+            view, patterns = payload
+            matcher = compile_patterns(patterns, basename_only=True)
+            hidden = dict(self.hidden)
+            if matcher:
+                hidden[view] = matcher
+            else:
+                hidden.pop(view, None)
+            self.hidden = hidden
+            return
+        elif event == u'refresh_cost':
+            view, cost = payload
+            self.stats.setdefault(view, RefreshStats()).finish_refresh(cost)
             return
-        self.paths = payload
+        elif event != u'paths':
+            return
+        view, view_paths = payload
+        paths, roots = dict(self.paths), dict(self.roots)
+        if view_paths:
+            paths[view] = frozenset(view_paths)
+            roots[view] = min(view_paths, key=len)
+        else:
+            paths.pop(view, None)
+            roots.pop(view, None)
+            hidden = dict(self.hidden)
+            hidden.pop(view, None)
+            self.hidden = hidden
+            self.stats.pop(view, None)
+            with self.lock:
+                self.scheduled_views.discard(view)
+        self.roots = roots
+        self.paths = paths
+
+    def is_ignored(self, path, view):
+        '''Return True if change of path shall not cause refresh of view; ignore patterns are
+        matched against path relative to directory of view, so view inside e.g. .git or target
+        directory is still refreshed'''
+        root = self.roots.get(view)
+        if root is not None and path.startswith(root + os.sep):
+            path = path[len(root) + 1:]
+        path = normalize(path)
+        if self.ignore and self.ignore.search(path):
+            return True
+        hidden = self.hidden.get(view)
+        return bool(hidden and hidden.search(path.rstrip('/')))
+
+    def dispatch(self, event):
+        '''Called by watchdog observer for each event'''
+        self.on_any_event(event)
 
     def on_any_event(self, event):
         '''
         File system event received from watchdog module,
-        not to be confused with package_events which we use for internal communication
+        not to be confused with common.channel which we use for internal communication
         dir(event) = ['event_type', 'is_directory', 'key', 'src_path']
         '''
-        if isinstance(event, DirModifiedEvent):
+        if event.is_directory and event.event_type == 'modified':
             # change of access time may cause modified event, which can be safely ignored
             # actual changes will fire the corresponding event types:
             # FileMovedEvent
@@ -180,34 +418,63 @@ class ReportEvent(FileSystemEventHandler):
             print('Ignore DirModified:', event.key)
             return
 
-        src_path = event.src_path
-        path = os.path.dirname(src_path)
-        for v, p in self.paths.items():
-            if any(i in p for i in (src_path, path)) and v not in self.ignore_views:
-                if not self.scheduled_views:
-                    self.schedule_refresh(v, datetime.datetime.now())
+        changed = [event.src_path]
+        if getattr(event, 'dest_path', None):
+            changed.append(event.dest_path)
+        # caches (VCS status, sizes of directories) must know about any change, even in ignored paths
+        for path in changed:
+            emit_event(u'changed', path, plugin=u'FileBrowserVCS')
+        ignore_views = self.ignore_views
+        with self.lock:
+            for v, p in self.paths.items():
+                if v in ignore_views:
+                    continue
+                # move (e.g. atomic save from hidden temporary file) is ignored only if both
+                # source and destination are ignored
+                if any((path in p or os.path.dirname(path) in p) and not self.is_ignored(path, v)
+                       for path in changed):
+                    self.stats.setdefault(v, RefreshStats()).add_event(time.time())
+                    self.scheduled_views.add(v)
+            start = self.scheduled_views and not self.scheduling
+            if start:
+                self.scheduling = True
+        if start:
+            sublime.set_timeout(self.schedule_refresh, SCHEDULE_REFRESH)
+
+    def schedule_refresh(self):
+        '''Refresh views which are due according to their RefreshStats, runs while there are
+        scheduled views; it reschedules itself even if something fails, otherwise auto-refresh
+        would stop for all views
+        '''
+        try:
+            self.refresh_due()
+        finally:
+            with self.lock:
+                if self.scheduled_views:
+                    sublime.set_timeout(self.schedule_refresh, SCHEDULE_REFRESH)
                 else:
-                    self.scheduled_views.update({v: datetime.datetime.now()})
-
-    def schedule_refresh(self, view=None, at=None):
-        now = datetime.datetime.now()
-        if view and at:
-            if time_out(at, now):
-                sublime.set_timeout(self.schedule_refresh, SCHEDULE_REFRESH)
-                return
-            else:
-                self.scheduled_views.update({view: at})
-
-        if not self.scheduled_views:
-            return
-
-        views = [v for v, t in self.scheduled_views.items() if time_out(t, now)]
-        for v in views:
-            self.scheduled_views.pop(v, None)
+                    self.scheduling = False
+
+    def refresh_due(self):
+        now = time.time()
+        views, storms = [], []
+        with self.lock:
+            scheduled = list(self.scheduled_views)
+        for v in scheduled:
+            stats = self.stats.setdefault(v, RefreshStats())
+            storm = stats.storm
+            if stats.due(now):
+                with self.lock:
+                    self.scheduled_views.discard(v)
+                stats.storm = False
+                views.append(v)
+            elif stats.storm and not storm:
+                storms.append(v)
+        if storms:
+            sublime.set_timeout(lambda: show_storm(storms), 1)
         if views:
-            sublime.set_timeout(lambda: refresh(views), 1)
-        sublime.set_timeout(self.schedule_refresh, SCHEDULE_REFRESH)
-        return
+            # watcher reports changes, so cached status of VCS is reliable, see vcs.StatusCache
+            sublime.set_timeout(lambda: refresh(views, args={'vcs_cache': True}), 1)
 
 
 if not ST3:
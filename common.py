@@ -31,6 +31,16 @@ RE_FILE = re.compile(r'^(\s*)([^\\//].*)$')
 PARENT_SYM = u"⠤"
 
 
+def plugin_loaded():
+    settings = sublime.load_settings('dired.sublime-settings')
+    channel.set_broadcast()
+    settings.add_on_change('dired_broadcast_events', channel.set_broadcast)
+
+
+def plugin_unloaded():
+    sublime.load_settings('dired.sublime-settings').clear_on_change('dired_broadcast_events')
+
+
 def first(seq, pred):
     '''similar to built-in any() but return the object instead of boolean'''
     return next((item for item in seq if pred(item)), None)
@@ -144,6 +154,71 @@ def hijack_window():
             sublime.set_timeout(lambda: sublime.windows()[-1].run_command("dired", {"immediate": True}), 1)
 
 
+def visible_views():
+    '''Return list of views which are visible in any group of any window, ordered by focus:
+    active view of active window first, then other groups of active window, then other windows
+    '''
+    active = sublime.active_window()
+    windows = sublime.windows()
+    if active:
+        windows = [active] + [w for w in windows if w.id() != active.id()]
+    views, ids = [], set()
+    for w in windows:
+        for v in [w.active_view()] + [w.active_view_in_group(g) for g in range(w.num_groups())]:
+            if v and v.id() not in ids:
+                ids.add(v.id())
+                views.append(v)
+    return views
+
+
+def refresh_views(views, args=None):
+    '''Refresh views which are visible right away in order of focus, other views are just marked
+    as dirty and will be refreshed upon activation (see dired_misc.DiredRefreshDirtyView)
+    views
+        list of sublime.View objects
+    args
+        dict, arguments for dired_refresh command
+    '''
+    args = args or {}
+    pending = dict((v.id(), v) for v in views)
+    for v in visible_views():
+        if pending.pop(v.id(), None):
+            v.settings().erase('dired_dirty')
+            v.run_command('dired_refresh', args)
+    for v in pending.values():
+        dirty = v.settings().get('dired_dirty', {})
+        dirty.update(args)
+        v.settings().set('dired_dirty', dirty)
+
+
+class EventChannel(object):
+    '''In-process channel between FileBrowser commands and filesystem observer, listeners are
+    called synchronously in the thread of sender, so they must be cheap (just update state)
+    '''
+    def __init__(self):
+        self.listeners = {}
+        self.broadcast = False  # dired_broadcast_events, kept current by set_broadcast
+
+    def set_broadcast(self):
+        '''callback for global setting dired_broadcast_events, so emit_event (called for every
+        event of watcher) does not ask settings'''
+        settings = sublime.load_settings('dired.sublime-settings')
+        self.broadcast = bool(package_events) and settings.get('dired_broadcast_events', False)
+
+    def listen(self, plugin, callback):
+        self.listeners[plugin] = self.listeners.get(plugin, ()) + (callback,)
+
+    def unlisten(self, plugin, callback):
+        self.listeners[plugin] = tuple(c for c in self.listeners.get(plugin, ()) if c != callback)
+
+    def notify(self, plugin, event_type, payload):
+        for callback in self.listeners.get(plugin, ()):
+            callback(plugin, event_type, payload)
+
+
+channel = EventChannel()
+
+
 def emit_event(event_type, payload, view=None, plugin=u'FileBrowser'):
     '''Notify our filesystem observer about changes in our views
     event_type
@@ -161,19 +236,23 @@ def emit_event(event_type, payload, view=None, plugin=u'FileBrowser'):
         FileBrowserWFS
             notifies FileSystemEventHandler about scheduled paths in order to schedule refresh when
             sth is changed on file system
+    Events go through in-process channel; if dired_broadcast_events setting is true, they are also
+    broadcast via package_events (if available) for other packages
     '''
-    if package_events is None:
-        return
     if view and not view.settings().get('dired_autorefresh', True):
-        package_events.notify(plugin, u'stop_watch', view.id())
-        return
-    package_events.notify(plugin, event_type, payload)
+        event_type, payload = u'stop_watch', view.id()
+    channel.notify(plugin, event_type, payload)
+    if channel.broadcast:
+        package_events.notify(plugin, event_type, payload)
 
 
 class DiredBaseCommand:
     """
     Convenience functions for dired TextCommands
     """
+    use_prefetched = False  # see listdir
+    known_dirs = {}         # full path: isdir, filled by listdir from prefetched listing
+
     @property
     def path(self):
         return self.view.settings().get('dired_path')
@@ -396,11 +475,13 @@ class DiredBaseCommand:
         settings        = self.view.settings()
         copied_items    = settings.get('dired_to_copy', [])
         cut_items       = settings.get('dired_to_move', [])
-        status = u" 𝌆 [?: Help] {0}Hidden: {1}{2}{3}".format(
+        storm           = settings.get('dired_autorefresh_storm', False)
+        status = u" 𝌆 [?: Help] {0}Hidden: {1}{2}{3}{4}".format(
             'Project root, ' if path_in_project else '',
             'On' if self.show_hidden else 'Off',
             ', copied(%d)' % len(copied_items) if copied_items else '',
-            ', cut(%d)' % len(cut_items) if cut_items else ''
+            ', cut(%d)' % len(cut_items) if cut_items else '',
+            ', auto-refresh waits for quiet' if storm else ''
         )
         self.view.set_status("__FileBrowser__", status)
 
@@ -420,7 +501,7 @@ class DiredBaseCommand:
         index_files = []
         for name in names:
             full_name = join(path, goto, name)
-            if isdir(full_name):
+            if self.is_directory(full_name):
                 index_dirs.append(u'%s%s' % (full_name, os.sep))
                 items.append(''.join([level, u"▸ ", name, os.sep]))
             else:
@@ -431,12 +512,17 @@ class DiredBaseCommand:
         items += files
         return items
 
-    def is_hidden(self, filename, path, goto=''):
-        if not (path or goto):  # special case for ThisPC
-            return False
+    def hidden_patterns(self):
+        '''Return list of patterns from dired_hidden_files_patterns setting'''
         tests = self.view.settings().get('dired_hidden_files_patterns', ['.*'])
         if isinstance(tests, str):
             tests = [tests]
+        return tests
+
+    def is_hidden(self, filename, path, goto=''):
+        if not (path or goto):  # special case for ThisPC
+            return False
+        tests = self.hidden_patterns()
         if any(fnmatch.fnmatch(filename, pattern) for pattern in tests):
             return True
         if sublime.platform() != 'windows':
@@ -450,6 +536,20 @@ class DiredBaseCommand:
             result = False
         return result
 
+    def hide_ignored(self, names, path):
+        '''Return names without items ignored by git, if dired_hide_git_ignored setting is true;
+        only answers which are already cached are used, so listing does not wait for git: items
+        unknown yet are asked on worker thread of dired_misc.CallVCS, which refreshes view then'''
+        settings = self.view.settings()
+        if not names or not settings.get('dired_hide_git_ignored', False):
+            return names
+        if ST3:
+            from .vcs import ignored_cache
+        else:
+            from vcs import ignored_cache
+        ignored = ignored_cache.known(path, names)
+        return [n for n in names if n not in ignored]
+
     def try_listing_directory(self, path):
         '''Return tuple of two element
             items  sorted list of filenames in path, or empty list
@@ -457,10 +557,12 @@ class DiredBaseCommand:
         '''
         items, error = [], ''
         try:
+            names = self.listdir(path)
             if not self.show_hidden:
-                items = [name for name in os.listdir(path) if not self.is_hidden(name, path)]
+                items = [name for name in names if not self.is_hidden(name, path)]
+                items = self.hide_ignored(items, path)
             else:
-                items = os.listdir(path)
+                items = names
         except OSError as e:
             error = str(e)
             if NT:
@@ -472,6 +574,27 @@ class DiredBaseCommand:
         finally:
             return items, error
 
+    def listdir(self, path):
+        '''Same as os.listdir, but if command navigates (self.use_prefetched is set), listing which
+        was prefetched while cursor rested on path is used (see prefetch.py), then isdir of its
+        items is known too, see is_directory'''
+        if self.use_prefetched:
+            if ST3:
+                from .prefetch import prefetcher
+            else:
+                from prefetch import prefetcher
+            listing = prefetcher.take(path)
+            if listing is not None:
+                names, dirs = listing
+                self.known_dirs = dict(self.known_dirs)
+                self.known_dirs.update((join(path, n), n in dirs) for n in names)
+                return list(names)
+        return os.listdir(path)
+
+    def is_directory(self, path):
+        known = self.known_dirs.get(path)
+        return isdir(path) if known is None else known
+
     def try_listing_only_dirs(self, path):
         '''Same as self.try_listing_directory, but items contains only directories.
         Used for prompt completion'''
@@ -563,3 +686,8 @@ class DiredBaseCommand:
         if folder.startswith(home):
             display = folder.replace(home, "~", 1)
         return display
+
+
+if not ST3:
+    plugin_loaded()
+    unload_handler = plugin_unloaded
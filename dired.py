@@ -6,21 +6,23 @@ from __future__ import print_function
 import sublime
 from sublime import Region
 from sublime_plugin import WindowCommand, TextCommand
-import os
+import os, stat, time
 from os.path import basename, dirname, isdir, exists, join
 
 ST3 = int(sublime.version()) >= 3000
 
 if ST3:
-    from .common import DiredBaseCommand, print, set_proper_scheme, calc_width, get_group, hijack_window, emit_event, NT, PARENT_SYM
+    from .common import DiredBaseCommand, print, set_proper_scheme, calc_width, get_group, hijack_window, emit_event, refresh_views, NT, PARENT_SYM
     from . import prompt
     from .show import show
     from .jumping import jump_names
+    from .samples import is_binary, IMAGE_EXTENSIONS
 else:  # ST2 imports
-    from common import DiredBaseCommand, print, set_proper_scheme, calc_width, get_group, hijack_window, emit_event, NT, PARENT_SYM
+    from common import DiredBaseCommand, print, set_proper_scheme, calc_width, get_group, hijack_window, emit_event, refresh_views, NT, PARENT_SYM
     import prompt
     from show import show
     from jumping import jump_names
+    from samples import is_binary, IMAGE_EXTENSIONS
 
 
 def reuse_view():
@@ -45,24 +47,9 @@ def plugin_loaded():
                 print('\ndired.plugin_loaded run recursively %d time(s); and failed to refresh\n' % recursive_plugin_loaded)
                 return
 
-    for w in sublime.windows():
-        for v in w.views():
-            if v.settings() and v.settings().get("dired_path"):
-                # reset sels because dired_index not exists yet, so we cant restore sels
-                v.run_command("dired_refresh", {"reset_sels": True})
-
-    import sys
-    dfsobserver = '%s0_dired_fs_observer' % ('FileBrowser.' if ST3 else '')
-    if dfsobserver not in sys.modules or sys.modules[dfsobserver].Observer is None:
-        return sublime.error_message(
-            u'FileBrowser:\n\n'
-            u'watchdog module is not importable, hence we cannot know about '
-            u'changes on file system, and auto-refresh will not work.\n\n'
-            u'Despite that, FileBrowser is fully usable without auto-refresh, '
-            u'you can just ignore this message and manually refresh view with r key.\n\n'
-            u'But if you want working auto-refresh:\n'
-            u' • if you install manually, then look at Readme how to install it,\n'
-            u' • if you install via Package Control, report an issue.')
+    views = [v for w in sublime.windows() for v in w.views() if v.settings() and v.settings().get("dired_path")]
+    # reset sels because dired_index not exists yet, so we cant restore sels
+    refresh_views(views, {"reset_sels": True})
 
     sublime.load_settings('dired.sublime-settings').add_on_change('dired_autorefresh', lambda: emit_event(u'toggle_watch_all', sublime.load_settings('dired.sublime-settings').get('dired_autorefresh', None)))
     # if not ST3:
@@ -156,7 +143,7 @@ class DiredRefreshCommand(TextCommand, DiredBaseCommand):
     to get full path, instead of grinding with substr thru entire view
     substr is slow: https://github.com/SublimeTextIssues/Core/issues/882
     """
-    def run(self, edit, goto='', to_expand=None, toggle=None, reset_sels=None):
+    def run(self, edit, goto='', to_expand=None, toggle=None, reset_sels=None, vcs_cache=None):
         """
         goto
             Optional filename to put the cursor on; used only from "dired_up"
@@ -170,7 +157,16 @@ class DiredRefreshCommand(TextCommand, DiredBaseCommand):
 
         reset_sels
             If True, previous selections & marks shan’t be restored
+
+        vcs_cache
+            If True, cached status of VCS may be used (auto-refresh, expand);
+            otherwise status is taken anew, since watcher does not see changes in
+            collapsed directories
         """
+        if self.view.settings().get('dired_disk_usage'):
+            # items were deleted, renamed, etc., see dired_misc.DiskUsage
+            return self.view.run_command('dired_disk_usage_render', {'prune': True})
+
         # after restart ST, callback seems to disappear, so reset callback on each refresh for more reliability
         self.view.settings().clear_on_change('color_scheme')
         self.view.settings().add_on_change('color_scheme', lambda: set_proper_scheme(self.view))
@@ -185,10 +181,15 @@ class DiredRefreshCommand(TextCommand, DiredBaseCommand):
             return
 
         emit_event(u'start_refresh', (self.view.id(), path), view=self.view)
+        started = time.time()
 
         self.expanded = expanded = self.view.find_all(u'^\s*▾') if not reset_sels else []
         self.show_hidden = self.view.settings().get('dired_show_hidden_files', True)
+        emit_event(u'hidden_patterns', (self.view.id(), tuple() if self.show_hidden else tuple(self.hidden_patterns())), plugin=u'FileBrowserWFS')
         self.goto = goto
+        self.vcs_cache = bool(vcs_cache)
+        # navigation (new path or dired_up) may use listing prefetched under cursor
+        self.use_prefetched, self.known_dirs = bool(reset_sels or goto), {}
         if os.sep in goto:
             to_expand = self.expand_goto(to_expand)
 
@@ -205,6 +206,7 @@ class DiredRefreshCommand(TextCommand, DiredBaseCommand):
                 self.marked, self.sels = None, None
             self.re_populate_view(edit, path, names, expanded, to_expand, toggle)
         emit_event(u'finish_refresh', (self.view.id(), self.expanded + ([path] if path else [])), view=self.view)
+        emit_event(u'refresh_cost', (self.view.id(), time.time() - started), plugin=u'FileBrowserWFS')
 
     def expand_goto(self, to_expand):
         '''e.g. self.goto = "a/b/c/d/", then to put cursor onto d, it should be
@@ -241,7 +243,7 @@ class DiredRefreshCommand(TextCommand, DiredBaseCommand):
         items = self.correcting_index(path, tree)
         self.write(edit, items)
         self.restore_selections(path)
-        self.view.run_command('dired_call_vcs', {'path': path})
+        self.view.run_command('dired_call_vcs', {'path': path, 'use_cache': self.vcs_cache})
 
     def populate_view(self, edit, path, names):
         '''Called when no directories were (or/and need to be) expanded'''
@@ -265,7 +267,7 @@ class DiredRefreshCommand(TextCommand, DiredBaseCommand):
         items = self.correcting_index(path, self.prepare_filelist(names, path, '', ''))
         self.write(edit, items)
         self.restore_selections(path)
-        self.view.run_command('dired_call_vcs', {'path': path})
+        self.view.run_command('dired_call_vcs', {'path': path, 'use_cache': self.vcs_cache})
 
     def traverse_tree(self, root, path, indent, tree, expanded):
         '''Recursively build list of filenames for self.re_populate_view'''
@@ -296,7 +298,7 @@ class DiredRefreshCommand(TextCommand, DiredBaseCommand):
         for f in items:
             new_path = join(path, f)
             dir_path = u'%s%s' % (new_path.rstrip(os.sep), os.sep)
-            check = isdir(new_path)
+            check = self.is_directory(new_path)
             if check and dir_path in expanded:
                 self.traverse_tree(root, dir_path, indent + '\t', tree, expanded)
             elif check:
@@ -478,6 +480,10 @@ class DiredPreviewCommand(DiredSelect):
             return
 
         if exists(fqn):
+            if ST3 and self.too_heavy(fqn):
+                # huge or binary file would be loaded and indexed by ST, show sample instead
+                self.view.run_command('dired_preview_file_sample', {'fqn': fqn})
+                return
             if ST3:
                 self.view.run_command('dired_file_properties', {'fqn': fqn})
             window = self.view.window()
@@ -488,6 +494,23 @@ class DiredPreviewCommand(DiredSelect):
         else:
             sublime.status_message(u'File does not exist (%s)' % (basename(fqn.rstrip(os.sep)) or fqn))
 
+    def too_heavy(self, fqn):
+        '''Return True if fqn is regular file bigger than dired_preview_max_size or binary one
+        (except images which ST can show); other files (e.g. FIFO) are never read here'''
+        settings = sublime.load_settings('dired.sublime-settings')
+        try:
+            st = os.stat(fqn)
+        except OSError:
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        if st.st_size > settings.get('dired_preview_max_size', 10485760):
+            return True
+        images = settings.get('dired_preview_image_extensions', IMAGE_EXTENSIONS)
+        if os.path.splitext(fqn)[1].lower() in images:
+            return False
+        return is_binary(fqn)
+
 
 class DiredExpand(TextCommand, DiredBaseCommand):
     '''Open directory(s) inline, aka treeview'''
@@ -495,6 +518,8 @@ class DiredExpand(TextCommand, DiredBaseCommand):
         '''
         toggle  if True, state of directory(s) will be toggled (i.e. expand/collapse)
         '''
+        if self.view.settings().get('dired_disk_usage'):
+            return sublime.status_message(u'Not available in disk usage view')
         self.index = self.get_all()
         filenames = self.get_marked(full=True) or self.get_selected(parent=False, full=True)
 
@@ -504,7 +529,7 @@ class DiredExpand(TextCommand, DiredBaseCommand):
             # working with several selections at once is very tricky, thus for reliability we should
             # recreate the entire tree, despite it is supposedly slower, but not really, because
             # one view.replace/insert() call is faster than multiple ones
-            self.view.run_command('dired_refresh', {'to_expand': filenames, 'toggle': toggle})
+            self.view.run_command('dired_refresh', {'to_expand': filenames, 'toggle': toggle, 'vcs_cache': True})
             return
         else:
             return sublime.status_message('Item cannot be expanded')
@@ -530,7 +555,9 @@ class DiredExpand(TextCommand, DiredBaseCommand):
         # line may have inline error msg after os.sep
         root = self.view.substr(line).split(os.sep)[0].replace(u'▸', u'▾', 1) + os.sep
 
+        self.use_prefetched, self.known_dirs = True, {}
         items, error = self.try_listing_directory(filename)
+        self.use_prefetched = False
         if error:
             replacement = [u'%s\t<%s>' % (root, error)]
         elif items:
@@ -547,7 +574,7 @@ class DiredExpand(TextCommand, DiredBaseCommand):
         self.view.settings().set('dired_index', self.index)
         self.restore_marks(marked)
         self.restore_sels((seled, [self.sel]))
-        self.view.run_command('dired_call_vcs', {'path': self.path})
+        self.view.run_command('dired_call_vcs', {'path': self.path, 'use_cache': True})
         emit_event(u'finish_refresh', (self.view.id(), [filename]), view=self.view)
 
     def try_to_fold(self, marked):
@@ -591,6 +618,8 @@ class DiredFold(TextCommand, DiredBaseCommand):
 
         Call self.fold method on each line (multiple selections/marks), restore marks and selections
         '''
+        if self.view.settings().get('dired_disk_usage'):
+            return sublime.status_message(u'Not available in disk usage view')
         v = self.view
         self.update = update
         self.index  = index or self.get_all()
@@ -803,6 +832,13 @@ class DiredToggleHiddenFilesCommand(TextCommand):
         self.view.run_command('dired_refresh')
 
 
+class DiredUpdateStatusCommand(TextCommand, DiredBaseCommand):
+    '''Update status-bar without refresh, e.g. when observer changes state of auto-refresh'''
+    def run(self, edit):
+        self.show_hidden = self.view.settings().get('dired_show_hidden_files', True)
+        self.set_status()
+
+
 # MOUSE INTERATIONS #################################################
 
 def dired_mouse(view, args):
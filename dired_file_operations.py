@@ -217,6 +217,8 @@ class DiredDeleteCommand(TextCommand, DiredBaseCommand):
 
 class DiredRenameCommand(TextCommand, DiredBaseCommand):
     def run(self, edit):
+        if self.view.settings().get('dired_disk_usage'):
+            return sublime.status_message(u'Not available in disk usage view')
         if not self.filecount():
             return sublime.status_message('Directory seems empty, nothing could be renamed')
 
@@ -8,24 +8,34 @@ from __future__ import print_function
 import sublime, sublime_plugin
 from sublime import Region
 from sublime_plugin import TextCommand, EventListener
-import glob
 import math
 import os
+import stat
 import subprocess
 import sys
 import threading
-from os.path import dirname, isfile, isdir, exists, join, normpath, getsize, getctime, getatime, getmtime
+from os.path import dirname, isdir, exists, join, normpath
 from datetime import datetime
 
 ST3 = int(sublime.version()) >= 3000
 
 if ST3:
-    from .common import DiredBaseCommand, set_proper_scheme, hijack_window, emit_event, NT, OSX, PARENT_SYM, sort_nicely
+    from .common import DiredBaseCommand, set_proper_scheme, hijack_window, emit_event, first, NT, OSX, PARENT_SYM, sort_nicely
+    from .sizes import previews, LargestItems
+    from .stats import stat_pool, stat_cache, count_cache
+    from .samples import read_sample, hexdump, HEX_BYTES
+    from .prefetch import prefetcher
+    from .vcs import status_cache, status_jobs, hg_servers, HgServerError, ignored_cache, find_command, IGNORED, index_states, GitIndexError, parse_git_status, parse_hg_status, rollup, dominant
     MARK_OPTIONS = sublime.DRAW_NO_OUTLINE
     SYNTAX_EXTENSION = '.sublime-syntax'
 else:  # ST2 imports
     import locale
-    from common import DiredBaseCommand, set_proper_scheme, hijack_window, emit_event, NT, OSX, PARENT_SYM, sort_nicely
+    from common import DiredBaseCommand, set_proper_scheme, hijack_window, emit_event, first, NT, OSX, PARENT_SYM, sort_nicely
+    from sizes import previews, LargestItems
+    from stats import stat_pool, stat_cache, count_cache
+    from samples import read_sample, hexdump, HEX_BYTES
+    from prefetch import prefetcher
+    from vcs import status_cache, status_jobs, hg_servers, HgServerError, ignored_cache, find_command, IGNORED, index_states, GitIndexError, parse_git_status, parse_hg_status, rollup, dominant
     MARK_OPTIONS = 0
     SYNTAX_EXTENSION = '.hidden-tmLanguage'
     sublime_plugin.ViewEventListener = object
@@ -42,19 +52,13 @@ def convert_size(size):
 
 
 def get_dates(path):
+    '''Return tuple of formatted ctime, atime, mtime (exception instead of each if stat failed)'''
     try:
-        created = datetime.fromtimestamp(getctime(path)).strftime('%d %b %Y, %H:%M:%S')
+        st = stat_cache.stat(path)
     except OSError as e:
-        created = e
-    try:
-        accessed = datetime.fromtimestamp(getatime(path)).strftime('%d %b %Y, %H:%M:%S')
-    except OSError as e:
-        accessed = e
-    try:
-        modified = datetime.fromtimestamp(getmtime(path)).strftime('%d %b %Y, %H:%M:%S')
-    except OSError as e:
-        modified = e
-    return created, accessed, modified
+        return e, e, e
+    return tuple(datetime.fromtimestamp(t).strftime('%d %b %Y, %H:%M:%S')
+                 for t in (st.st_ctime, st.st_atime, st.st_mtime))
 
 
 class DiredFindInFilesCommand(TextCommand, DiredBaseCommand):
@@ -281,6 +285,291 @@ class DiredToggleAutoRefresh(TextCommand):
         self.view.run_command('dired_refresh')
 
 
+class DiredToggleDetails(TextCommand):
+    '''Show size, modification time and mode of items; ST3 only'''
+    captions = (u'Show details', u'Hide details')
+
+    def mode(self):
+        return Details
+
+    def is_enabled(self):
+        return ST3 and hasattr(sublime, 'PhantomSet') and self.view.score_selector(0, "text.dired") > 0
+
+    def is_visible(self):
+        return self.is_enabled()
+
+    def description(self):
+        return self.captions[bool(self.view.settings().get(self.mode().SETTING, False))]
+
+    def run(self, edit):
+        s = self.view.settings()
+        s.set(self.mode().SETTING, not s.get(self.mode().SETTING, False))
+        self.mode().sync(self.view)
+
+
+class DiredToggleChildCounts(DiredToggleDetails):
+    '''Show number of items next to collapsed directories; ST3 only'''
+    captions = (u'Show number of items in directories', u'Hide number of items in directories')
+
+    def mode(self):
+        return ChildCounts
+
+
+class Details(object):
+    '''Details mode of view: size, modification time and mode of items are shown as phantoms at the
+    beginning of rows (so columns are aligned); only rows in and near viewport are stat'ed, on
+    stats.stat_pool, so opening huge directory does not wait for stat of every item
+    '''
+    SETTING = 'dired_details'
+    MARGIN = 1  # viewport heights above and below visible rows
+    POLL = 200  # ms, there is no event for scrolling
+    views = {}  # view id: Details
+
+    @classmethod
+    def sync(cls, view):
+        '''Start or stop details mode according to setting'''
+        details = cls.views.get(view.id())
+        if view.settings().get(cls.SETTING, False):
+            if details is None and hasattr(sublime, 'PhantomSet'):
+                cls.views[view.id()] = details = cls(view)
+                details.poll()
+        elif details is not None:
+            del cls.views[view.id()]
+            details.phantoms.update([])
+
+    def __init__(self, view):
+        self.view = view
+        self.phantoms = sublime.PhantomSet(view, self.SETTING)
+        self.stats = {}         # path: os.stat_result or None
+        self.requested = set()  # paths which are being stat'ed
+        self.change_count = None
+        self.shown = None       # rows and number of known stats in the last update
+
+    def poll(self):
+        if self.views.get(self.view.id()) is not self:
+            return
+        if not self.view.settings().has('dired_index'):
+            del self.views[self.view.id()]  # view was closed
+            return
+        self.update()
+        sublime.set_timeout(self.poll, self.POLL)
+
+    def rows(self):
+        visible = self.view.visible_region()
+        first, last = self.view.rowcol(visible.a)[0], self.view.rowcol(visible.b)[0]
+        margin = (last - first + 1) * self.MARGIN
+        return max(0, first - margin), last + margin
+
+    def update(self):
+        '''Called on main thread; render known stats, request missing ones'''
+        if self.views.get(self.view.id()) is not self:
+            return
+        change_count = self.view.change_count()
+        if change_count != self.change_count:
+            # view was refreshed, items may be changed
+            self.change_count = change_count
+            self.stats, self.requested = {}, set()
+        first, last = self.rows()
+        if self.shown == (change_count, first, last, len(self.stats)):
+            return
+        self.shown = (change_count, first, last, len(self.stats))
+        index = self.view.settings().get('dired_index', [])
+        phantoms, missing = [], []
+        for row, path in enumerate(index[first:last + 1], first):
+            if not self.wanted(index, row):
+                continue
+            if path in self.stats:
+                phantoms.append(self.phantom(row, self.stats[path]))
+            elif path not in self.requested:
+                missing.append(path)
+        self.phantoms.update(phantoms)
+        if missing:
+            self.requested.update(missing)
+            stat_pool.submit(missing, self.on_stats, self.function())
+
+    def wanted(self, index, row):
+        return index[row] and index[row] != PARENT_SYM
+
+    def function(self):
+        '''Return function which is called for each path on stats.stat_pool, None means stat'''
+        return None
+
+    def phantom(self, row, st):
+        point = self.view.text_point(row, 0)
+        return sublime.Phantom(Region(point, point), self.html(st), sublime.LAYOUT_INLINE)
+
+    def on_stats(self, stats):
+        '''Called on worker thread'''
+        def apply():
+            if not any(p in self.requested for p in stats):
+                return  # view was refreshed meanwhile
+            self.stats.update(stats)
+            self.update()
+        sublime.set_timeout(apply, 1)
+
+    def html(self, st):
+        if st is None:
+            text = u'%10s  %16s  %10s  ' % ('?', '', '')
+        else:
+            size = '' if stat.S_ISDIR(st.st_mode) else convert_size(st.st_size)
+            mtime = datetime.fromtimestamp(st.st_mtime).strftime('%Y-%m-%d %H:%M')
+            text = u'%10s  %s  %s  ' % (size, mtime, stat.filemode(st.st_mode))
+        return (u'<body id="dired-details"><style>span {{ color: color(var(--foreground) alpha(0.5)); }}</style>'
+                u'<span>{0}</span></body>'.format(text.replace(' ', '&nbsp;')))
+
+
+class ChildCounts(Details):
+    '''Number of items in collapsed directories (expanded ones show their items anyway) after their
+    names, so empty directory is seen without expanding it; counting stops after limit, see
+    stats.CountCache, and hidden items are not counted unless they are shown'''
+    SETTING = 'dired_child_counts'
+    views = {}  # view id: ChildCounts
+
+    def wanted(self, index, row):
+        path = index[row]
+        if not path.endswith(os.sep) or path == PARENT_SYM:
+            return False
+        return not (row + 1 < len(index) and index[row + 1].startswith(path))  # not expanded
+
+    def function(self):
+        settings = self.view.settings()
+        limit = settings.get('dired_child_counts_limit', 999)
+        patterns = ()
+        if not settings.get('dired_show_hidden_files', True):
+            patterns = settings.get('dired_hidden_files_patterns', ['.*'])
+            if isinstance(patterns, str):
+                patterns = [patterns]
+        return lambda path: count_cache.count(path, limit, patterns)
+
+    def phantom(self, row, count):
+        point = self.view.line(self.view.text_point(row, 0)).b
+        return sublime.Phantom(Region(point, point), self.html(count), sublime.LAYOUT_INLINE)
+
+    def html(self, count):
+        limit = self.view.settings().get('dired_child_counts_limit', 999)
+        text = u'?' if count is None else u'empty' if not count else u'%d+' % limit if count > limit else str(count)
+        return (u'<body id="dired-child-counts"><style>span {{ color: color(var(--foreground) alpha(0.5)); }}</style>'
+                u'<span>&nbsp;&nbsp;{0}</span></body>'.format(text))
+
+
+class DiredDiskUsageCommand(TextCommand, DiredBaseCommand):
+    '''Show the largest files and directories under current directory in separate view; ST3 only'''
+    def is_enabled(self):
+        return (ST3 and hasattr(sublime, 'PhantomSet') and self.view.score_selector(0, "text.dired") > 0
+                and self.get_path() != '')
+
+    def is_visible(self):
+        return self.is_enabled()
+
+    def run(self, edit):
+        path = self.path
+        if self.view.settings().get('dired_disk_usage'):
+            return DiskUsage.start(self.view, path)  # scan again
+        window = self.view.window()
+        view = first(window.views(), lambda v: v.settings().get('dired_disk_usage') and v.settings().get('dired_path') == path)
+        if not view:
+            view = window.new_file()
+            view.settings().add_on_change('color_scheme', lambda: set_proper_scheme(view))
+            view.set_syntax_file('Packages/FileBrowser/dired-disk-usage' + SYNTAX_EXTENSION)
+            view.set_scratch(True)
+            view.set_name(u'𝌆 disk usage: %s' % (os.path.basename(path.rstrip(os.sep)) or path))
+            settings = view.settings()
+            settings.set('dired_path', path)
+            settings.set('dired_disk_usage', True)
+            settings.set('dired_autorefresh', False)
+            settings.set('dired_index', ['', ''])
+        window.focus_view(view)
+        DiskUsage.start(view, path)
+
+
+class DiskUsage(object):
+    '''Disk usage view: rows of sizes.LargestItems are re-rendered while scan goes on, sizes are
+    phantoms (like in details mode), so rows are normal items which can be marked, deleted, etc.
+    '''
+    POLL = 500  # ms between renders while scanning
+    views = {}  # view id: DiskUsage
+
+    @classmethod
+    def start(cls, view, path):
+        usage = cls.views.pop(view.id(), None)
+        if usage is not None:
+            usage.scan.cancel()
+        settings = sublime.load_settings('dired.sublime-settings')
+        scan = LargestItems(path, settings.get('dired_disk_usage_top', 100),
+                            settings.get('dired_size_one_filesystem', False)).start()
+        cls.views[view.id()] = usage = cls(view, scan)
+        usage.poll()
+
+    def __init__(self, view, scan):
+        self.view = view
+        self.scan = scan
+        self.phantoms = sublime.PhantomSet(view, 'dired_disk_usage')
+        self.shown = None
+
+    def poll(self):
+        if DiskUsage.views.get(self.view.id()) is not self:
+            return
+        if not self.view.settings().has('dired_index'):
+            del DiskUsage.views[self.view.id()]  # view was closed
+            self.scan.cancel()
+            return
+        finished = self.scan.wait(0)
+        state = (self.scan.files, self.scan.errors, finished)
+        if state != self.shown:
+            self.shown = state
+            self.view.run_command('dired_disk_usage_render')
+        if not finished:
+            sublime.set_timeout(self.poll, self.POLL)
+
+
+class DiredDiskUsageRenderCommand(TextCommand, DiredBaseCommand):
+    '''Write rows of disk usage view keeping marks and cursor; called by DiskUsage.poll and instead
+    of dired_refresh (e.g. after deleting), then removed items are dropped from result'''
+    def run(self, edit, prune=False):
+        usage = DiskUsage.views.get(self.view.id())
+        if usage is None:  # e.g. plugin was reloaded
+            return DiskUsage.start(self.view, self.path)
+        scan = usage.scan
+        if prune:
+            for size, path in scan.largest():
+                if not os.path.lexists(path.rstrip(os.sep)):
+                    scan.discard(path)
+        self.index = self.view.settings().get('dired_index', [])
+        marked = set(self.get_marked(full=True))
+        selected = self.get_selected(full=True) or []
+
+        path = self.path
+        items = scan.largest()
+        status = u'' if scan.wait(0) else u', scanning…'
+        if scan.errors:
+            status += u', %d errors' % scan.errors
+        header = u'%s — %s in %d files%s' % (path, convert_size(scan.size), scan.files, status)
+        rows = [u'%s %s' % (u'▸' if p.endswith(os.sep) else u'≡', p.replace(path, '', 1)) for s, p in items]
+        self.view.set_read_only(False)
+        self.view.replace(edit, Region(0, self.view.size()), u'\n'.join([header, u'—' * len(header)] + rows))
+        self.view.set_read_only(True)
+        self.index = ['', ''] + [p for s, p in items]
+        self.view.settings().set('dired_index', self.index)
+        self.view.settings().set('dired_count', len(items))
+
+        lines = [self.view.line(self.view.text_point(row, 0)) for row in range(2, len(self.index))]
+        regions = [Region(self._get_name_point(l), l.b) for l, p in zip(lines, self.index[2:]) if p in marked]
+        if regions:
+            self.view.add_regions('marked', regions, 'dired.marked', '', MARK_OPTIONS)
+        else:
+            self.view.erase_regions('marked')
+        rows = [self.index.index(p) for p in selected if p in self.index] or [min(2, len(self.index) - 1)]
+        self.view.sel().clear()
+        for row in rows:
+            point = self._get_name_point(self.view.line(self.view.text_point(row, 0)))
+            self.view.sel().add(Region(point, point))
+
+        html = (u'<body id="dired-disk-usage"><style>span {{ color: color(var(--foreground) alpha(0.5)); }}</style>'
+                u'<span>{0}</span></body>')
+        usage.phantoms.update([sublime.Phantom(Region(l.a, l.a), html.format((u'%10s  ' % convert_size(s)).replace(' ', '&nbsp;')), sublime.LAYOUT_INLINE)
+                               for l, (s, p) in zip(lines, items)])
+
+
 class DiredPreviewDirectoryCommand(TextCommand, DiredBaseCommand):
     '''Show properties and content of directory in popup; ST3 only'''
     def run(self, edit, fqn=None, point=0):
@@ -293,7 +582,6 @@ class DiredPreviewDirectoryCommand(TextCommand, DiredBaseCommand):
             if not (isdir(fqn) or fqn == PARENT_SYM):
                 return sublime.status_message(u'Something wrong')
 
-        self.view.settings().set('dired_stop_preview_thread', False)
         self.preview_thread = threading.Thread(target=self.worker, args=(fqn if fqn != PARENT_SYM else self.get_path(),))
         self.preview_thread.start()
         width, height = self.view.viewport_extent()
@@ -303,35 +591,37 @@ class DiredPreviewDirectoryCommand(TextCommand, DiredBaseCommand):
         self.preview_path = '📁 <a href="dir\v{0}">{0}</a>'.format(path)
         self.subdirs = self.files = self.size = 0
         self.errors = []
-        self.open_dirs = []
-        self.open_files = []
+        self.links = None
         self._created, self._accessed, self._modified = get_dates(path)
 
-        def add_err(err): self.errors.append(str(err))
-
-        for index, (root, dirs, files) in enumerate(os.walk(path, onerror=add_err)):
-            self.subdirs += len(dirs)
-            self.files += len(files)
-
-            if not index:
-                sort_nicely(dirs)
-                sort_nicely(files)
-                self.open_dirs = ['📁 <a href="dir\v%s%s">%s</a>' % (join(root, d), os.sep, d) for d in dirs]
-                self.open_files = []
-
-            for f in files:
-                fpath = join(root, f)
-                if not index:
-                    self.open_files.append('≡ <a href="file\v%s">%s</a>' % (fpath, f))
-                try:
-                    self.size += getsize(fpath)
-                except OSError as e:
-                    add_err(e)
-
-            if not self.view.is_popup_visible() or self.view.settings().get('dired_stop_preview_thread'):
-                return
-            sublime.set_timeout_async(self.update_preview(), 1)
-        sublime.set_timeout_async(self.update_preview(loading=False), 1)
+        one_filesystem = self.view.settings().get('dired_size_one_filesystem', False)
+        engine, token = previews.start(self.view.id(), path, one_filesystem)
+        shown = None
+        # popup is updated at most 10 times per second and only if counters were changed
+        while not engine.wait(0.1):
+            if not self.view.is_popup_visible() or not previews.is_current(self.view.id(), token):
+                # scan is cancelled soon, unless next preview of the same path continues it
+                return previews.release(self.view.id(), engine)
+            self.collect(engine)
+            if shown != (self.files, self.subdirs, len(self.errors)):
+                shown = (self.files, self.subdirs, len(self.errors))
+                sublime.set_timeout_async(self.update_preview, 1)
+        if not previews.is_current(self.view.id(), token):
+            return
+        self.collect(engine)
+        sublime.set_timeout_async(lambda: self.update_preview(loading=False), 1)
+
+    def collect(self, engine):
+        '''Take totals from sizes.DirectorySize; links to top level items are rendered once'''
+        self.subdirs, self.files, self.size = engine.subdirs, engine.files, engine.size
+        self.errors = list(engine.errors)
+        if self.links is None and (engine.top_dirs or engine.top_files):
+            dirs, files = list(engine.top_dirs), list(engine.top_files)
+            sort_nicely(dirs)
+            sort_nicely(files)
+            items = (['📁 <a href="dir\v%s%s">%s</a>' % (join(engine.path, d), os.sep, d) for d in dirs] +
+                     ['≡ <a href="file\v%s">%s</a>' % (join(engine.path, f), f) for f in files])
+            self.links = ' %s<br><br>' % '<br> '.join(items)
 
     def update_preview(self, loading=True):
         le = len(self.errors)
@@ -341,21 +631,20 @@ class DiredPreviewDirectoryCommand(TextCommand, DiredBaseCommand):
             else:
                 errors = '<br><a href="errors\v">%s errors</a> (click to view)<br><br>' % le
         else:
-            errors = '<br>Errors:<br> %s<br><br>' % '<br> '.join(self.errors) if self.errors else '<br>'
-        items = self.open_dirs + self.open_files
+            errors = '<br>Errors:<br> %s<br><br>' % '<br> '.join(self.errors) if self.errors else '<br>'
         self.view.update_popup(
             '<br>{0}{1}<br><br>'
             'Files: {2}; directories: {3}<br>'
             'Size: {4} ({5} bytes)<br><br>'
-            'Created:  {6}<br>'
-            'Accessed: {7}<br>'
+            'Created:  {6}<br>'
+            'Accessed: {7}<br>'
             'Modified: {8}<br>{9}{10}'.format(
                 'Loading... ' if loading else '', self.preview_path,
                 self.files, self.subdirs,
                 convert_size(self.size), self.size,
                 self._created, self._accessed, self._modified,
                 errors,
-                ' %s<br><br>' % '<br> '.join(items) if items else '')
+                self.links or '')
         )
 
     def open_from_preview(self, payload):
@@ -405,7 +694,7 @@ class DiredFilePropertiesCommand(TextCommand, DiredBaseCommand):
         self.errors = []
         self._created, self._accessed, self._modified = get_dates(path)
         try:
-            self.size += getsize(path)
+            self.size += stat_cache.stat(path).st_size
         except OSError as e:
             self.errors.append(str(e))
         if not self.view.is_popup_visible():
@@ -460,6 +749,55 @@ class DiredFilePropertiesCommand(TextCommand, DiredBaseCommand):
         case[msg](path)
 
 
+class DiredPreviewFileSampleCommand(DiredFilePropertiesCommand):
+    '''Show head and tail of file (hex dump if binary) in popup, used by DiredPreviewCommand instead
+    of opening huge or binary file; ST3 only'''
+    def run(self, edit, fqn=None, point=0):
+        if not fqn:
+            self.index = self.get_all()
+            filenames = self.get_selected(full=True)
+            if not filenames:
+                return sublime.status_message(u'Nothing to preview')
+            fqn = filenames[0]
+        size = sublime.load_settings('dired.sublime-settings').get('dired_preview_sample_kb', 8) * 1024
+        width, height = self.view.viewport_extent()
+        self.view.show_popup('Loading...', 0, point or self.view.sel()[0].begin(), width, height / 2, self.open_from_preview)
+        sublime.set_timeout_async(lambda: self.update_sample(fqn, size), 1)
+
+    def update_sample(self, path, size):
+        try:
+            total, head, tail, codec, bom = read_sample(path, size)
+        except EnvironmentError as e:
+            total, content = 0, u'Error: %s' % self.escape(str(e))
+        else:
+            if codec is None:
+                if len(head) + len(tail) == total:  # no gap
+                    head, tail = (head + tail)[:HEX_BYTES], (head + tail)[max(HEX_BYTES, total - HEX_BYTES):]
+                else:
+                    head, tail = head[:HEX_BYTES], tail[-HEX_BYTES:]
+                kind, joint = u'binary', u'<br>'
+                parts = [self.escape(u'\n'.join(hexdump(head))), self.escape(u'\n'.join(hexdump(tail, total - len(tail))))]
+            else:
+                kind, joint = codec, u''
+                parts = [self.escape(head[bom:].decode(codec, 'replace')), self.escape(tail.decode(codec, 'replace'))]
+            skipped = total - len(head) - len(tail)
+            if skipped:
+                joint = u'<br><br>… %d bytes …<br><br>' % skipped
+            content = u'Content: %s<br><br>%s' % (kind, parts[0] + (joint + parts[1] if tail else u''))
+        if not self.view.is_popup_visible():
+            return
+        self.view.update_popup(
+            u'<br>≡ <a href="file\v{0}">{0}</a><br><br>'
+            u'Size: {1} ({2} bytes)<br>'
+            u'{3}<br><br>'
+            u'<a href="file\v{0}">Open anyway</a><br>'
+            u'<a href="app\v{0}">Open in default app</a><br><br>'.format(path, convert_size(total), total, content))
+
+    def escape(self, text):
+        text = text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;')
+        return text.replace(u'\t', u'    ').replace(u' ', u'&nbsp;').replace(u'\r', u'').replace(u'\n', u'<br>')
+
+
 # EVENT LISTENERS ###################################################
 
 class DiredHoverProperties(sublime_plugin.ViewEventListener, DiredBaseCommand):
@@ -469,7 +807,7 @@ class DiredHoverProperties(sublime_plugin.ViewEventListener, DiredBaseCommand):
 
     def on_hover(self, point, hover_zone):
         self.view.hide_popup()
-        self.view.settings().set('dired_stop_preview_thread', True)
+        previews.detach(self.view.id())
         if hover_zone != sublime.HOVER_GUTTER:
             return
         self.index = self.get_all()
@@ -486,6 +824,56 @@ class DiredHoverProperties(sublime_plugin.ViewEventListener, DiredBaseCommand):
             self.view.run_command('dired_preview_directory', {'fqn': path, 'point': self.name_point})
 
 
+class DiredDetailsMode(EventListener):
+    '''Start details mode (and child counts) for view which has its setting (e.g. by default or
+    restored after restart), see DiredToggleDetails'''
+    def on_activated(self, view):
+        for mode in (Details, ChildCounts):
+            if view.settings().get(mode.SETTING, False) and view.id() not in mode.views:
+                mode.sync(view)
+
+
+class DiredRefreshDirtyView(EventListener):
+    '''Refresh view which was not visible when refresh was requested, see common.refresh_views'''
+    def on_activated(self, view):
+        settings = view.settings()
+        if not settings.has('dired_dirty'):
+            return
+        args = settings.get('dired_dirty') or {}
+        settings.erase('dired_dirty')
+        view.run_command('dired_refresh', args)
+
+
+class DiredPrefetchListener(EventListener):
+    '''When cursor rests on directory row, fetch its listing (and listing of parent of view, for
+    dired_up) in background, see prefetch.Prefetcher'''
+    IDLE = 300  # ms
+
+    def on_selection_modified(self, view):
+        settings = view.settings()
+        if not settings.get('dired_path') or settings.get('dired_disk_usage') or not settings.get('dired_prefetch', True):
+            return
+        sels = view.sel()
+        if len(sels) == 1:
+            point = sels[0].a
+            sublime.set_timeout(lambda: self.prefetch(view, point), self.IDLE)
+
+    def prefetch(self, view, point):
+        sels = view.sel()
+        if len(sels) != 1 or sels[0].a != point:
+            return  # cursor moved meanwhile
+        settings = view.settings()
+        index = settings.get('dired_index', [])
+        row = view.rowcol(point)[0]
+        path = settings.get('dired_path', '')
+        if row < len(index) and index[row].endswith(os.sep):
+            prefetcher.request(index[row])
+        if path != 'ThisPC\\':
+            parent = dirname(path.rstrip(os.sep))
+            if parent and parent + os.sep != path:
+                prefetcher.request(parent)
+
+
 class DiredHijackNewWindow(EventListener):
     def on_window_command(self, window, command_name, args):
         if command_name != "new_window":
@@ -511,6 +899,23 @@ class DiredHideEmptyGroup(EventListener):
             sublime.set_timeout(lambda: w.set_layout({"cols": [0.0, 1.0], "rows": [0.0, 1.0], "cells": [[0, 0, 1, 1]]}), 300)
 
 
+git_failure_reported = False
+
+
+def report_git_failure(error):
+    '''Tell user once per session that git status failed, VCS marks are not shown then'''
+    global git_failure_reported
+    print(u'FileBrowser: git status failed:', error.strip())
+    if git_failure_reported:
+        return
+    git_failure_reported = True
+    sublime.set_timeout(lambda: sublime.error_message(
+        u'FileBrowser:\n\n'
+        u'git status failed, hence changed files cannot be marked.\n\n'
+        u'Git 2.15 or newer is required, please, check version of "git_path".\n\n'
+        u'%s' % error.strip()), 1)
+
+
 def is_any_dired_in_group(window, group):
     syntax = 'Packages/FileBrowser/dired%s' % SYNTAX_EXTENSION
     return any(v.settings().get('syntax') == syntax for v in window.views_in_group(group))
@@ -555,111 +960,324 @@ class DiredMoveOpenOrNewFileToRightGroup(EventListener):
 
 # TOOLS #############################################################
 
+# region key (the same as state, see vcs.PRIORITY): scope
+VCS_REGIONS = {'M': 'item.modified.dired',
+               'A': 'item.staged.dired',
+               'D': 'item.deleted.dired',
+               'R': 'item.renamed.dired',
+               'U': 'item.conflicted.dired',
+               '?': 'item.untracked.dired',
+               '!': 'item.ignored.dired'}
+
+
 class DiredCallVcs(TextCommand):
     '''Command allows to call it from other module(s)'''
-    def run(self, edit, path):
-        CallVCS(self.view, path)
+    def run(self, edit, path, use_cache=False):
+        CallVCS(self.view, path, use_cache)
 
 
 class CallVCS(DiredBaseCommand):
     '''Magic'''
-    def __init__(self, view, path):
+    POLL = 200  # ms, rows scrolled into view are checked while index fast path is used, see poll_visible
+
+    def __init__(self, view, path, use_cache=False):
         self.view = view
-        self.vcs_state = dict(path=path)
-        self.view.erase_regions('M')
-        self.view.erase_regions('?')
+        self.use_cache = use_cache  # False for explicit refresh, see DiredRefreshCommand
+        # untracked files are enumerated only if some subdirectory is expanded, see scope
+        self.vcs_state = dict(path=path, expanded=bool(view.find_all(u'^\s*▾')), listed=self.get_all())
+        if view.settings().get('git_index_fast_path', False):
+            self.vcs_state['visible'] = self.visible_files()
+            self.vcs_state['checked'] = set(self.vcs_state['visible'])
+        # listed ignored items are hidden by refresh, unless this CallVCS follows such refresh
+        settings = view.settings()
+        self.vcs_state['hide_ignored'] = (settings.get('dired_hide_git_ignored', False) and
+                                          not settings.get('dired_show_hidden_files', True) and
+                                          not settings.get('dired_hiding_ignored'))
+        settings.erase('dired_hiding_ignored')
+        for key in VCS_REGIONS:
+            self.view.erase_regions(key)
+        # previous CallVCS for this view (if still running) is superseded
+        self.generation = status_jobs.next_generation(view.id())
         for vcs in ['git', 'hg']:
             self.start(vcs)
-        self.watch_threads()
+        self.done()
 
-    def watch_threads(self):
-        '''wait while all checks are done'''
-        if not all(vcs in self.vcs_state for vcs in ['git', 'hg']):
-            sublime.set_timeout(self.watch_threads, 100)
+    def current(self):
+        return status_jobs.is_current(self.view.id(), self.generation)
+
+    def done(self):
+        '''called on main thread when check for one vcs is finished; colorize once all are done'''
+        if not all(vcs in self.vcs_state for vcs in ['git', 'hg']) or not self.current():
+            return
+        if 'changed_items' in self.vcs_state and not self.vcs_state.get('colorized'):
+            self.vcs_state['colorized'] = True
+            self.vcs_colorized(self.vcs_state['changed_items'], self.vcs_state['rolled_items'])
+        if 'fast_path' in self.vcs_state and not self.vcs_state.get('polling'):
+            self.vcs_state['polling'] = True
+            sublime.set_timeout(self.poll_visible, self.POLL)
+
+    def poll_visible(self):
+        '''called on main thread while this CallVCS is current; result of index fast path covers
+        only rows which were visible, so files scrolled into view are checked as well (there is
+        no event for scrolling, like in Details.poll)'''
+        if not self.current() or not self.view.settings().has('dired_index'):
             return
-        if 'changed_items' in self.vcs_state:
-            self.vcs_colorized(self.vcs_state['changed_items'])
+        if not self.vcs_state.get('checking'):
+            files = [f for f in self.visible_files() if f not in self.vcs_state['checked']]
+            if files:
+                self.vcs_state['checking'] = True
+                self.vcs_state['checked'].update(files)
+                threading.Thread(target=self.check_scrolled, args=(files,)).start()
+        sublime.set_timeout(self.poll_visible, self.POLL)
+
+    def check_scrolled(self, files):
+        '''target function for a thread, see poll_visible'''
+        command, root = self.vcs_state['fast_path']
+        try:
+            value = self.check_index(command, root, files)
+        finally:
+            self.vcs_state['checking'] = False
+        if not value or not value[0]:
+            return
+        def apply():
+            if not self.current():
+                return
+            changed_items = self.vcs_state.setdefault('changed_items', {})
+            changed_items.update(value[0])
+            self.vcs_colorized(changed_items, self.vcs_state.get('rolled_items', {}))
+        sublime.set_timeout(apply, 1)
 
     def start(self, vcs):
         '''launch threads'''
         command = self.view.settings().get('%s_path' % vcs, '')
-        if command:  # user can set empty string to disable integration with vcs
-            vars(self)['%s_thread' % vcs] = threading.Thread(target=self.check, args=(vcs, command))
+        # user can set empty string to disable integration with vcs
+        root = status_cache.get_root(vcs, self.vcs_state['path']) if command else ''
+        if root:
+            vars(self)['%s_thread' % vcs] = threading.Thread(target=self.worker, args=(vcs, command, root))
             vars(self)['%s_thread' % vcs].start()
         else:
             self.vcs_state.update({vcs: False})
+        if vcs == 'hg' and not root:
+            hg_servers.use(self.view.id(), '')  # let command server of previous repository go
 
-    def check(self, vcs, command):
-        '''target function for a thread; worker'''
-        status, root = self.get_output(vcs, self.expand_command(vcs, command))
-        if status and root:
+    def worker(self, vcs, command, root):
+        '''target function for a thread, report completion to main thread'''
+        try:
+            self.check(vcs, command, root)
+        finally:
+            self.vcs_state.setdefault(vcs, False)
+            sublime.set_timeout(self.done, 1)
+
+    def check(self, vcs, command, root):
+        '''status is taken from status_cache if possible, see vcs.StatusCache; only one status
+        runs per repository, requests waiting for it most likely find its result in cache'''
+        path = self.vcs_state['path']
+        command = self.expand_command(vcs, command)
+        scope = self.scope(vcs, root, path)
+        if not self.use_cache:
+            status_cache.forget(vcs, root, scope)
+        cached = status_cache.get(vcs, root, scope)
+        value = cached[1] if cached and not cached[2] else None
+        if cached is None and vcs == 'git' and self.vcs_state.get('visible'):
+            value = self.check_index(command, root, self.vcs_state['visible'])
+            if value is not None:
+                self.vcs_state['fast_path'] = (command, root)
+        if value is None:
+            with status_jobs.repo_lock(vcs, root):
+                if not self.current():
+                    return
+                cached = status_cache.get(vcs, root, scope)
+                if cached and cached[2]:
+                    value = self.update_status(command, root, *cached)
+                elif cached:
+                    value = cached[1]
+                else:
+                    status = self.get_output(vcs, command, root, scope)
+                    if status is None:
+                        return  # cancelled
+                    if not ST3:
+                        status = unicode(status, 'utf-8')
+                    changed = (parse_git_status if vcs == 'git' else parse_hg_status)(status, root)
+                    value = (changed, rollup(changed, root))
+                    status_cache.put(vcs, root, scope, value)
+                if value is None:
+                    return  # cancelled
+        changed, rolled = value
+        ignored = self.ignored_items(command, root) if vcs == 'git' and self.current() else []
+        if ignored and self.vcs_state['hide_ignored']:
+            sublime.set_timeout(self.hide_ignored_items, 1)
+        if changed or ignored:
             changed_items = self.vcs_state.get('changed_items', {})
-            changed_items.update(dict(self.set_value(vcs, root, i) for i in status if i != ''))
-            self.vcs_state.update({vcs: True, 'changed_items': changed_items})
+            changed_items.update(changed)
+            for item in ignored:
+                changed_items[item] = changed_items.get(item, '') + IGNORED
+            rolled_items = self.vcs_state.get('rolled_items', {})
+            rolled_items.update(rolled)
+            self.vcs_state.update({vcs: True, 'changed_items': changed_items, 'rolled_items': rolled_items})
         else:
             self.vcs_state.update({vcs: False})
 
+    def hide_ignored_items(self):
+        '''called on main thread when listed items turned out to be ignored, see
+        DiredBaseCommand.hide_ignored, which did not know about them'''
+        if self.current() and self.view.settings().has('dired_index'):
+            self.view.settings().set('dired_hiding_ignored', True)
+            self.view.run_command('dired_refresh', {'vcs_cache': True})
+
+    def update_status(self, command, root, scope, value, touched):
+        '''Ask git only about paths touched since status was cached (see vcs.StatusCache.on_event)
+        and merge answer into cached status, so saving one file does not rescan whole tree
+        Return new value or None if cancelled'''
+        pathspecs = [u':(literal)%s' % os.path.relpath(p, root) for p in touched]
+        status = self.get_output('git', command, root, (pathspecs, scope[1]))
+        if status is None:
+            return None
+        if not ST3:
+            status = unicode(status, 'utf-8')
+        changed = dict((p, states) for p, states in value[0].items()
+                       if not any(p == t or p.startswith(t + os.sep) for t in touched))
+        changed.update(parse_git_status(status, root))
+        value = (changed, rollup(changed, root))
+        status_cache.update('git', root, scope, touched, value)
+        return value
+
+    def ignored_items(self, command, root):
+        '''Return list of full paths of listed items which are ignored by git, see vcs.IgnoredCache'''
+        dirs = {}
+        for item in self.vcs_state['listed'] or []:
+            if item and item != PARENT_SYM:
+                directory, name = os.path.split(item.rstrip(os.sep))
+                dirs.setdefault(directory, []).append(name)
+        ignored = []
+        for directory, names in dirs.items():
+            ignored.extend(join(directory, n) for n in ignored_cache.ignored(command, root, directory, names))
+        return ignored
+
+    def visible_files(self):
+        '''Return list of full paths of files in rows currently visible in view'''
+        index = self.get_all()
+        visible = self.view.visible_region()
+        first, last = self.view.rowcol(visible.a)[0], self.view.rowcol(visible.b)[0]
+        return [f for f in index[first:last + 1] if f and not f.endswith(os.sep)]
+
+    def check_index(self, command, root, files):
+        '''Fast path for git: compare visible files with .git/index, only files which cannot be
+        decided by index alone are passed to git status; result is not cached, since it covers
+        only visible rows and does not include staged changes and directories
+        Return tuple (changed, rolled) or None if index cannot be read or git failed'''
+        try:
+            changed, ambiguous = index_states(root, files)
+        except (GitIndexError, IOError, OSError):
+            return None
+        if ambiguous:
+            pathspecs = [u':(literal)%s' % os.path.relpath(f, root) for f in ambiguous]
+            status = self.get_output('git', command, root, (pathspecs, 'all'))
+            if status is None:
+                return None
+            if not ST3:
+                status = unicode(status, 'utf-8')
+            changed.update(parse_git_status(status, root))
+        return (changed, {})
+
+    def scope(self, vcs, root, path):
+        '''Return tuple (pathspec, untracked) which limits status to the view's directory
+            pathspec   path relative to root, empty string means whole repository
+            untracked  "all" or "normal"; in latter case untracked directory is reported as one item,
+                       so git does not have to enumerate its content unless something is expanded
+        hg status is not limited, because hg prints cwd-relative paths for patterns
+        '''
+        if vcs != 'git':
+            return ('', 'all')
+        path, root = normpath(path), normpath(root)
+        pathspec = os.path.relpath(path, root) if path.startswith(root) else '.'
+        untracked = 'all' if self.vcs_state['expanded'] else 'normal'
+        return ('' if pathspec == '.' else pathspec, untracked)
+
     def expand_command(self, vcs, command):
         '''check if user got wildcards or envvars in custom command'''
-        if any(c for c in '~*?[]$%' if c in command) and not isfile(command):
-            match = glob.glob(os.path.expandvars(os.path.expanduser(command)))
-            if match:
-                return match[0]
+        match = find_command(command)
+        if match is None:
+            sublime.error_message(u'FileBrowser:\n'
+                u'It seems like you use wildcards in\n\n"%s_path": "%s".\n\n'
+                u'But the pattern cannot be found, please, fix it '
+                u'or use absolute path without wildcards.' % (vcs, command))
+            return command
+        return match
+
+    def get_output(self, vcs, command, cwd, scope=None):
+        '''call a vsc status, getting its output if any, None if it was cancelled by newer CallVCS
+        scope is tuple returned by self.scope, used only for git; pathspec may be list of few paths
+        as well, then git must not refresh index, otherwise cached status would be invalidated'''
+        args = {'git': ['status', '--porcelain=v2', '-z'],
+                'hg':  ['status']}[vcs]
+        if scope and vcs == 'git':
+            pathspec, untracked = scope
+            if isinstance(pathspec, list):
+                args = ['--no-optional-locks'] + args
             else:
-                sublime.error_message(u'FileBrowser:\n'
-                    u'It seems like you use wildcards in\n\n"%s_path": "%s".\n\n'
-                    u'But the pattern cannot be found, please, fix it '
-                    u'or use absolute path without wildcards.' % (vcs, command))
-        return command
-
-    def get_output(self, vcs, command):
-        '''call a vsc, getting its output if any'''
-        args = {'git_status': ['status', '--untracked-files=all', '-z'],
-                'git_root':   ['rev-parse', '--show-toplevel'],
-                'hg_status':  ['status'],
-                'hg_root':    ['root']}
-        sep = {'hg': '\n', 'git': '\x00' if ST3 else '\00'}
-        status, root, shell = '', '', True if NT else False
-        path = self.vcs_state['path']
+                pathspec = [pathspec] if pathspec else []
+            args = args + ['--untracked-files=%s' % untracked] + (['--'] + pathspec if pathspec else [])
+        if vcs == 'hg':
+            try:
+                output = hg_servers.run(self.view.id(), command, cwd, args)
+                if not self.current():
+                    return None
+                return output.decode('utf-8') if ST3 else output
+            except HgServerError:
+                pass  # e.g. too old hg, run it as usual
+        shell = True if NT else False
         try:
-            p = subprocess.Popen([command] + args['%s_status' % vcs], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=path, shell=shell)
-            status = p.communicate()[0]
-            status = str(status, 'utf-8').split(sep[vcs]) if ST3 else status.split(sep[vcs])
-            p = subprocess.Popen([command] + args['%s_root' % vcs], stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=path, shell=shell)
-            root = p.communicate()[0].decode('utf-8').strip('\n')
+            p = subprocess.Popen([command] + args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, cwd=cwd, shell=shell)
+            if not status_jobs.started(self.view.id(), self.generation, p):
+                return None
+            output, error = p.communicate()
+            status_jobs.finished(self.view.id(), p)
+            if p.returncode < 0 or not self.current():
+                return None  # killed or superseded, output may be incomplete
+            if p.returncode > 0 and vcs == 'git':
+                # most likely git older than 2.15 (no --porcelain=v2 or --no-optional-locks);
+                # empty output must not be cached as clean tree
+                report_git_failure(error.decode('utf-8', 'replace') if ST3 else error)
+                return None
+            return output.decode('utf-8') if ST3 else output
         except:
             # on Windows exception is not being raised if cwd is not None and shell=True
-            self.vcs_state.update({vcs: False})
-        return (status, root)
+            return ''
 
-    def set_value(self, vcs, root, item):
-        '''return tuple (fullpath, status)'''
-        item = item[1:] if vcs == 'git' else item
-        filename = (item[2:] if ST3 else unicode(item[2:], 'utf-8'))
-        return (join(root, filename), item[0])
-
-    def vcs_colorized(self, changed_items):
-        '''called on main thread'''
+    def vcs_colorized(self, changed_items, rolled_items):
+        '''called on main thread
+        changed_items  dict {fullpath: states}, see vcs.parse_git_status
+        rolled_items   dict {directory: states}, used for collapsed directories'''
         if not self.view.settings().has('dired_index'):
             return  # view was closed
-        modified, untracked = [], []
-        files_regions = dict((f, r) for f, r in zip(self.get_all(), self.view.split_by_newlines(Region(0, self.view.size()))))
+        regions = dict((key, []) for key in VCS_REGIONS)
+        # only plain lookup is built for all rows, view is asked only about rows which changed;
+        # directories are in index with trailing slash, but not in changed_items
+        rows = dict((f.rstrip(os.sep), i) for i, f in enumerate(self.get_all()) if f)
+        states = {}  # row: name point and states
+        for items, rolled in ((changed_items, False), (rolled_items, True)):
+            for fn, state in items.items():
+                row = rows.get(fn)
+                if row is None:
+                    continue
+                if row not in states:
+                    point = self.view.text_point(row, 0)
+                    states[row] = [self._get_name_point(Region(point, point)), '']
+                name_point = states[row][0]
+                if rolled and u'▾' in self.view.substr(Region(self.view.text_point(row, 0), name_point)):
+                    continue  # expanded directory shows its own items
+                states[row][1] += state
         colorblind = self.view.settings().get('vcs_color_blind', False)
         offset = 1 if not colorblind else 0
-        for fn in changed_items.keys():
-            full_fn = normpath(fn)
-            r = files_regions.get(full_fn, 0)
-            if r:
-                icon   = self._get_name_point(r) - 2
-                r      = Region(icon, icon + offset)
-                status = changed_items[fn]
-                if status == 'M':
-                    modified.append(r)
-                elif status == '?':
-                    untracked.append(r)
-        if colorblind:
-            self.view.add_regions('M', modified, 'item.colorblind.dired', '', MARK_OPTIONS | sublime.DRAW_EMPTY_AS_OVERWRITE)
-            self.view.add_regions('?', untracked, 'item.colorblind.dired', '', MARK_OPTIONS | sublime.DRAW_EMPTY)
-        else:
-            self.view.add_regions('M', modified, 'item.modified.dired', '', MARK_OPTIONS)
-            self.view.add_regions('?', untracked, 'item.untracked.dired', '', MARK_OPTIONS)
+        for name_point, row_states in states.values():
+            state = dominant(row_states)
+            if state:
+                icon = name_point - 2
+                regions[state].append(Region(icon, icon + offset))
+        for key, scope in VCS_REGIONS.items():
+            if colorblind:
+                flags = sublime.DRAW_EMPTY if key in '?!' else sublime.DRAW_EMPTY_AS_OVERWRITE
+                self.view.add_regions(key, regions[key], 'item.colorblind.dired', '', MARK_OPTIONS | flags)
+            else:
+                self.view.add_regions(key, regions[key], scope, '', MARK_OPTIONS)
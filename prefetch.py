@@ -0,0 +1,105 @@
+# coding: utf-8
+
+'''Listings of directories fetched in background while cursor rests on directory row (and of parent
+of view), so opening, expanding or going up does not wait for slow (e.g. network) file system;
+see dired_misc.DiredPrefetchListener and common.DiredBaseCommand.listdir'''
+
+from __future__ import print_function
+import os, threading, time
+from os.path import isdir, join
+import sublime
+
+ST3 = int(sublime.version()) >= 3000
+
+if ST3:
+    from .common import channel
+else:  # ST2 imports
+    from common import channel
+
+TTL = 10          # seconds: prefetched listing is used that long unless watcher reports change
+MAX_ENTRIES = 8   # listings kept at once, the oldest ones are dropped
+MAX_NAMES = 5000  # listing of bigger directory is not kept
+MAX_THREADS = 2   # requests are dropped while that many listings are being fetched
+
+
+def plugin_loaded():
+    channel.listen(u'FileBrowserVCS', prefetcher.on_event)
+
+
+def plugin_unloaded():
+    channel.unlisten(u'FileBrowserVCS', prefetcher.on_event)
+
+
+class Prefetcher(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # path with trailing separator: (timestamp, mtime, names, names of directories)
+        self.running = {}  # path: False if change was reported while fetching
+
+    def key(self, path):
+        return path if path.endswith(os.sep) else path + os.sep
+
+    def request(self, path):
+        key = self.key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if key in self.running or len(self.running) >= MAX_THREADS:
+                return
+            if entry is not None and time.time() - entry[0] < TTL:
+                return
+            self.running[key] = True
+        thread = threading.Thread(target=self.fetch, args=(key,))
+        thread.daemon = True
+        thread.start()
+
+    def fetch(self, key):
+        try:
+            mtime = os.stat(key).st_mtime  # before listing, so change during listing is noticed
+            names = os.listdir(key)
+            if len(names) > MAX_NAMES:
+                names = None
+            else:
+                dirs = frozenset(n for n in names if isdir(join(key, n)))
+        except OSError:
+            names = None
+        with self.lock:
+            valid = self.running.pop(key, False)
+            if names is None or not valid:
+                return
+            self.entries[key] = (time.time(), mtime, names, dirs)
+            while len(self.entries) > MAX_ENTRIES:
+                del self.entries[min(self.entries, key=lambda k: self.entries[k][0])]
+
+    def take(self, path):
+        '''Return tuple (names, names of directories) and forget it, None if there is no fresh
+        listing of path; mtime is checked, because directory may be not watched (e.g. collapsed
+        one or parent of view, or auto-refresh is off)'''
+        with self.lock:
+            entry = self.entries.pop(self.key(path), None)
+        if entry is None or time.time() - entry[0] > TTL:
+            return None
+        try:
+            if os.stat(path).st_mtime != entry[1]:
+                return None
+        except OSError:
+            return None
+        return entry[2], entry[3]
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event, payload is path which was changed'''
+        if event != u'changed':
+            return
+        path = payload.rstrip(os.sep)
+        with self.lock:
+            for key in (self.key(path), self.key(os.path.dirname(path))):
+                self.entries.pop(key, None)
+                if key in self.running:
+                    self.running[key] = False
+
+
+prefetcher = Prefetcher()
+
+
+if not ST3:
+    plugin_loaded()
+    unload_handler = plugin_unloaded
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+'''Head and tail of file read through mmap, so preview of huge file does not load it (see
+dired_misc.DiredPreviewFileSampleCommand)'''
+
+from __future__ import print_function
+import os, stat, mmap, codecs
+
+HEX_BYTES = 512  # bytes of head and of tail shown as hex dump
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico']  # ST shows them as images
+
+# (bom, codec, size of code unit); UTF-32 LE must be checked before UTF-16 LE, BOM is the same
+BOMS = ((codecs.BOM_UTF32_LE, 'utf-32-le', 4), (codecs.BOM_UTF32_BE, 'utf-32-be', 4),
+        (codecs.BOM_UTF8, 'utf-8', 1),
+        (codecs.BOM_UTF16_LE, 'utf-16-le', 2), (codecs.BOM_UTF16_BE, 'utf-16-be', 2))
+
+
+def sniff_encoding(head):
+    '''Return tuple (codec or None if content is binary, length of BOM, size of code unit)'''
+    for bom, codec, unit in BOMS:
+        if head.startswith(bom):
+            return codec, len(bom), unit
+    if b'\0' in head:
+        return None, 0, 1
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError as e:
+        if e.end < len(head) - 3:  # not just a character cut at the end of sample
+            return 'latin-1', 0, 1
+    return 'utf-8', 0, 1
+
+
+def read_sample(path, size):
+    '''Return tuple (file size, head, tail, codec, length of BOM), where head and tail are at most
+    size bytes each (tail is empty if whole file fits into head), raise EnvironmentError'''
+    if not stat.S_ISREG(os.stat(path).st_mode):
+        raise IOError('not a regular file')  # e.g. open of FIFO would block
+    with open(path, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        if not total:
+            return 0, b'', b'', 'utf-8', 0
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        head = mm[:size]
+        codec, bom, unit = sniff_encoding(head)
+        head = head[:len(head) - (len(head) - bom) % unit]  # head and tail are whole code units
+        start = max(len(head), total - size)
+        start += (bom - start) % unit
+        tail = mm[start:total]
+    finally:
+        mm.close()
+    return total, head, tail, codec, bom
+
+
+def is_binary(path, size=8192):
+    '''Return True if head of file looks binary (NUL byte without BOM of UTF-16/32)'''
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(size)
+    except EnvironmentError:
+        return False
+    return sniff_encoding(head)[0] is None
+
+
+def hexdump(data, offset=0):
+    '''Return list of lines like `hexdump -C`'''
+    lines = []
+    data = bytearray(data)
+    for i in range(0, len(data), 16):
+        chunk = data[i:i + 16]
+        hexes = ' '.join('%02x' % b for b in chunk)
+        text = ''.join(chr(b) if 32 <= b < 127 else '.' for b in chunk)
+        lines.append('%08x  %-47s  |%s|' % (offset + i, hexes, text))
+    return lines
@@ -40,16 +40,18 @@ def set_active_group(window, view, other_group):
 
 def set_view(view_id, window, ignore_existing, path, single_pane):
     view = None
+    # disk usage view (see dired_misc.DiskUsage) is never reused for listing
+    listing = lambda v: not v.settings().get('dired_disk_usage')
     if view_id:
         # The Goto command was used so the view is already known and its contents should be
         # replaced with the new path.
-        view = first(window.views(), lambda v: v.id() == view_id)
+        view = first(window.views(), lambda v: v.id() == view_id and listing(v))
 
     if not view and not ignore_existing:
         # See if a view for this path already exists.
-        same_path = lambda v: v.settings().get('dired_path') == path
+        same_path = lambda v: v.settings().get('dired_path') == path and listing(v)
         # See if any reusable view exists in case of single_pane argument
-        any_path = lambda v: v.score_selector(0, "text.dired") > 0
+        any_path = lambda v: v.score_selector(0, "text.dired") > 0 and listing(v)
         view = first(window.views(), any_path if single_pane else same_path)
 
     if not view:
@@ -0,0 +1,524 @@
+# coding: utf-8
+
+'''Recursive size of directories, used by DiredPreviewDirectoryCommand (see dired_misc):
+directories are scanned by a pool of threads (stat releases GIL, so it is faster on big trees),
+subtotals of directories are kept on disk between sessions; LargestItems is used by disk usage view
+'''
+
+from __future__ import print_function
+import os, stat, threading, time, pickle, heapq
+import sublime
+
+try:
+    import queue
+except ImportError:  # ST2
+    import Queue as queue
+
+ST3 = int(sublime.version()) >= 3000
+
+if ST3:
+    from .common import channel
+else:  # ST2 imports
+    from common import channel
+
+scandir = getattr(os, 'scandir', None)  # absent in Python 3.3 of ST3
+
+WORKERS = 4
+TOTAL_AGE = 60        # seconds: total of directory is trusted without checking its subdirectories
+RECORD_AGE = 3600     # seconds: content of directory with the same mtime is trusted
+MAX_RECORDS = 100000  # the oldest records are dropped when cache is saved
+SAVE_DELAY = 30       # seconds: changed cache is written at most that often (and on unload)
+GRACE = 2             # seconds: scan of hidden preview is cancelled unless previewed again meanwhile
+
+
+def plugin_loaded():
+    channel.listen(u'FileBrowserVCS', size_cache.on_event)
+    channel.listen(u'FileBrowser', previews.on_event)
+
+
+def plugin_unloaded():
+    channel.unlisten(u'FileBrowserVCS', size_cache.on_event)
+    channel.unlisten(u'FileBrowser', previews.on_event)
+    previews.cancel_all()
+    size_cache.save()
+
+
+class Entry(object):
+    '''Subset of os.DirEntry for Python without os.scandir'''
+    __slots__ = ('name', 'path', '_lstat')
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            return os.stat(self.path)
+        return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+
+def list_entries(path):
+    '''Return list of entries of directory, os.DirEntry objects if possible, Entry otherwise'''
+    if scandir:
+        return list(scandir(path))
+    return [Entry(path, name) for name in os.listdir(path)]
+
+
+class SizeCache(object):
+    '''Subtotals of directories, stored in cache path of Sublime Text
+    Record of directory is list [mtime, timestamp, own, children, total, total timestamp, links], where
+        own       tuple (size, files, subdirs) of items directly inside directory, size of files
+                  with several hardlinks is not included
+        children  tuple of names of subdirectories which were scanned
+        total     tuple (size, files, subdirs) of whole tree, None if unknown; it is stored only
+                  for tree without files with several hardlinks
+        links     tuple of (device, inode, size) of files with several hardlinks, so every scan
+                  can count them once, no matter which directory is taken from cache
+    Own subtotal is valid while mtime of directory is the same (i.e. no item was added, removed or
+    renamed) and watcher did not report change of its file; total is valid while no change was
+    reported anywhere below, see on_event. Changes of files in directories which are not watched
+    are noticed after RECORD_AGE (TOTAL_AGE for totals).
+    Records are replaced, never modified in place, so save can pickle shallow copy without lock.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.saving = threading.Lock()
+        self.records = None  # (path, one_filesystem): record, loaded on demand
+        self.dirty = False
+        self.timer = None    # pending save, see changed
+
+    def filename(self):
+        return os.path.join(sublime.cache_path(), 'FileBrowser', 'sizes.cache')
+
+    def load(self):
+        if self.records is not None:
+            return
+        self.records = {}
+        try:
+            with open(self.filename(), 'rb') as f:
+                records = pickle.load(f)
+            # records of older format are dropped
+            self.records = dict((k, r) for k, r in records.items() if len(r) == 7)
+        except Exception:  # missing or broken file, start from scratch
+            pass
+
+    def get(self, path, mtime, one_filesystem):
+        '''Return record (copy) if own subtotal of path is valid, otherwise None'''
+        with self.lock:
+            self.load()
+            record = self.records.get((path, one_filesystem))
+            if record is None or record[0] != mtime or time.time() - record[1] > RECORD_AGE:
+                return None
+            return list(record)
+
+    def put(self, path, one_filesystem, mtime, own, children, links):
+        with self.lock:
+            self.load()
+            self.records[(path, one_filesystem)] = [mtime, time.time(), own, children, None, 0, links]
+            self.changed()
+
+    def set_totals(self, totals, one_filesystem):
+        '''totals is dict {path: total}'''
+        now = time.time()
+        with self.lock:
+            self.load()
+            for path, total in totals.items():
+                record = self.records.get((path, one_filesystem))
+                if record is not None:
+                    self.records[(path, one_filesystem)] = record[:4] + [total, now] + record[6:]
+                    self.changed()
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event, payload is path which was changed: own subtotal of
+        its directory and totals of all ancestors are invalid'''
+        if event != u'changed' or self.records is None:
+            return
+        path = payload.rstrip(os.sep)
+        parent = os.path.dirname(path)
+        with self.lock:
+            changed = False
+            for one_filesystem in (False, True):
+                for key in ((path, one_filesystem), (parent, one_filesystem)):
+                    changed = self.records.pop(key, None) is not None or changed
+                directory = parent
+                while True:
+                    record = self.records.get((directory, one_filesystem))
+                    if record is not None and record[4] is not None:
+                        self.records[(directory, one_filesystem)] = record[:4] + [None, record[5]] + record[6:]
+                        changed = True
+                    up = os.path.dirname(directory)
+                    if up == directory:
+                        break
+                    directory = up
+            if changed:
+                self.changed()
+
+    def changed(self):
+        '''Called with lock held; schedule save'''
+        self.dirty = True
+        if self.timer is None and ST3:
+            self.timer = threading.Timer(SAVE_DELAY, self.save)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def save(self):
+        '''Write cache to disk if it was changed; pickling is done without lock, so watcher and
+        scans are not blocked'''
+        with self.saving:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty or not ST3:
+                    return
+                records = dict(self.records)
+                self.dirty = False
+            if len(records) > MAX_RECORDS:
+                by_age = sorted(records, key=lambda k: records[k][1])
+                old = by_age[:len(records) - MAX_RECORDS]
+                for key in old:
+                    del records[key]
+                with self.lock:
+                    for key in old:
+                        self.records.pop(key, None)
+            data = pickle.dumps(records, 2)
+            filename = self.filename()
+            try:
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename))
+                with open(filename + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(filename + '.tmp', filename)
+            except (IOError, OSError) as e:
+                print('FileBrowser: cannot save size cache:', e)
+
+
+size_cache = SizeCache()
+
+
+class DirectorySize(object):
+    '''Count size, files and subdirectories of path recursively
+        • symlinks are not followed, their own size is counted;
+        • file with several hardlinks is counted once;
+        • if one_filesystem, mount points are counted, but not scanned;
+        • names of top level directories and files are collected for preview;
+        • subtotals of unchanged directories are taken from cache (see SizeCache), so only
+          changed branches are listed again.
+    Usage: engine = DirectorySize(path).start(); while not engine.wait(0.1): show progress
+    '''
+    def __init__(self, path, one_filesystem=False, workers=WORKERS, cache=None):
+        self.path = path
+        self.one_filesystem = one_filesystem
+        self.workers = workers
+        self.cache = size_cache if cache is None else cache
+        self.visited = {}  # path: (own, children paths, total or None, links) for rollup
+        self.size = self.files = self.subdirs = 0
+        self.errors = []
+        self.top_dirs, self.top_files = [], []
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.queue = queue.Queue()
+        self.inodes = set()  # (device, inode) of files with several hardlinks
+        self.pending = 0     # directories which are queued or being scanned
+        self.device = None
+
+    def start(self):
+        try:
+            self.device = os.lstat(self.path).st_dev
+        except OSError as e:
+            self.errors.append(str(e))
+            self.finished.set()
+            return self
+        self.pending = 1
+        self.queue.put(self.path)
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        '''Return True if scan is finished (or cancelled)'''
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+    def cancel(self):
+        '''Queued directories are dropped, workers exit quickly'''
+        self.cancelled = True
+
+    def work(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                return
+            if not self.cancelled:
+                self.scan(path)
+            with self.lock:
+                self.pending -= 1
+                finished = not self.pending
+            if finished:
+                if not self.cancelled:
+                    self.rollup()
+                self.finished.set()
+                for _ in range(self.workers):
+                    self.queue.put(None)
+
+    def rollup(self):
+        '''Sum subtotals of visited directories from the deepest ones and store totals of trees
+        without hardlinks (size of such file cannot be counted once if total is taken from cache)'''
+        totals, linked = {}, set()
+        for path in sorted(self.visited, key=lambda p: p.count(os.sep), reverse=True):
+            own, children, total, links = self.visited[path]
+            if total is None:
+                if not all(c in totals for c in children):
+                    continue  # subdirectory failed, total is unknown
+                total = tuple(sum(t) for t in zip(own, *[totals[c] for c in children]))
+            totals[path] = total
+            if links or any(c in linked for c in children):
+                linked.add(path)
+        self.cache.set_totals(dict((p, t) for p, t in totals.items() if p not in linked),
+                              self.one_filesystem)
+
+    def count_links(self, links):
+        '''Return size of files with several hardlinks which were not counted yet in this scan'''
+        size = 0
+        with self.lock:
+            for dev, ino, link_size in links:
+                if (dev, ino) not in self.inodes:
+                    self.inodes.add((dev, ino))
+                    size += link_size
+        return size
+
+    def add(self, size, files, subdirs, errors=None, descend=None):
+        with self.lock:
+            self.size += size
+            self.files += files
+            self.subdirs += subdirs
+            self.errors.extend(errors or [])
+            self.pending += len(descend or [])
+        for d in descend or []:
+            self.queue.put(d)
+
+    def scan(self, path):
+        try:
+            mtime = os.lstat(path).st_mtime
+            record = self.cache.get(path, mtime, self.one_filesystem) if path != self.path else None
+            if record is None:
+                entries = list_entries(path)
+        except OSError as e:
+            with self.lock:
+                self.errors.append(str(e))
+            return
+        if record is not None:
+            own, children, total, links = record[2], record[3], record[4], record[6]
+            if total is not None and time.time() - record[5] < TOTAL_AGE:
+                self.visited[path] = (own, (), total, ())
+                return self.add(*total)
+            descend = [os.path.join(path, c) for c in children]
+            self.visited[path] = (own, tuple(descend), None, links)
+            size, files, subdirs = own
+            return self.add(size + self.count_links(links), files, subdirs, descend=descend)
+        size, files, subdirs, descend, errors, links = 0, 0, 0, [], [], []
+        for entry in entries:
+            if self.cancelled:
+                return
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs += 1
+                    if not self.one_filesystem or entry.stat(follow_symlinks=False).st_dev == self.device:
+                        descend.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError as e:
+                errors.append(str(e))
+                continue
+            files += 1
+            if st.st_nlink > 1 and st.st_ino:
+                links.append((st.st_dev, st.st_ino, st.st_size))
+            else:
+                size += st.st_size
+        if path == self.path:
+            self.top_dirs = [e.name for e in entries if e.is_dir()]
+            self.top_files = [e.name for e in entries if not e.is_dir()]
+        own, links = (size, files, subdirs), tuple(links)
+        if not errors:
+            self.cache.put(path, self.one_filesystem, mtime, own, tuple(os.path.basename(d) for d in descend), links)
+        self.visited[path] = (own, tuple(descend), None, links)
+        self.add(size + self.count_links(links), files, subdirs, errors, descend)
+
+
+class Previews(object):
+    '''One DirectorySize per view: preview of another path cancels previous scan at once, preview
+    of the same path reuses scan which is still running, so its partial result is not lost;
+    token tells popup updater (see DiredPreviewDirectoryCommand.worker) whether it is still the
+    current one; when popup is hidden, scan is cancelled after GRACE seconds unless the same path
+    is previewed again (quick re-hover), see release'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engines = {}  # view id: DirectorySize
+        self.tokens = {}   # view id: token of the latest popup updater
+        self.started = {}  # view id: time of the latest start
+
+    def start(self, view_id, path, one_filesystem=False):
+        '''Return tuple (engine, token)'''
+        with self.lock:
+            engine = self.engines.get(view_id)
+            reuse = (engine is not None and engine.path == path and engine.one_filesystem == one_filesystem
+                     and not engine.cancelled and not engine.finished.is_set())
+            if not reuse:
+                if engine is not None:
+                    engine.cancel()
+                engine = self.engines[view_id] = DirectorySize(path, one_filesystem).start()
+            token = self.tokens[view_id] = self.tokens.get(view_id, 0) + 1
+            self.started[view_id] = time.time()
+            return engine, token
+
+    def release(self, view_id, engine):
+        '''Popup of engine is gone'''
+        released = time.time()
+
+        def cancel():
+            with self.lock:
+                if self.engines.get(view_id) is not engine or self.started.get(view_id, 0) > released:
+                    return  # another path is previewed (engine is cancelled already) or the same again
+                del self.engines[view_id]
+            engine.cancel()
+
+        timer = threading.Timer(GRACE, cancel)
+        timer.daemon = True
+        timer.start()
+
+    def detach(self, view_id):
+        '''Popup is gone, its updater must stop'''
+        with self.lock:
+            self.tokens[view_id] = self.tokens.get(view_id, 0) + 1
+
+    def is_current(self, view_id, token):
+        return self.tokens.get(view_id) == token
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event'''
+        if event == u'view_closed':
+            with self.lock:
+                engine = self.engines.pop(payload, None)
+                self.tokens.pop(payload, None)
+                self.started.pop(payload, None)
+            if engine is not None:
+                engine.cancel()
+
+    def cancel_all(self):
+        with self.lock:
+            engines, self.engines, self.tokens = list(self.engines.values()), {}, {}
+        for engine in engines:
+            engine.cancel()
+
+
+previews = Previews()
+
+
+class LargestItems(object):
+    '''Walk tree depth-first in one thread (total of directory is known as soon as its subtree is
+    done) and keep only the top largest files and directories in heaps, so memory depends on depth
+    of tree and top, not on number of items; symlinks, hardlinks and one_filesystem are treated
+    like in DirectorySize, directories in progress are not in result yet
+    Usage: scan = LargestItems(path, top).start(); scan.largest() at any time
+    '''
+    def __init__(self, path, top=100, one_filesystem=False):
+        self.path = path
+        self.top = top
+        self.one_filesystem = one_filesystem
+        self.size = self.files = self.errors = 0
+        self.top_files, self.top_dirs = [], []  # heaps of (size, path), path of directory ends with os.sep
+        self.inodes = set()
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self.walk)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        '''Return True if scan is finished (or cancelled)'''
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def largest(self):
+        '''Return list of (size, path) sorted by size, the largest first'''
+        with self.lock:
+            items = self.top_files + self.top_dirs
+        return sorted(items, reverse=True)
+
+    def discard(self, path):
+        '''Item was removed: forget it and items inside it, subtract its size from ancestors'''
+        inside = lambda p: p == path or (path.endswith(os.sep) and p.startswith(path))
+        with self.lock:
+            size = next((s for s, p in self.top_files + self.top_dirs if p == path), 0)
+            self.top_files = [i for i in self.top_files if not inside(i[1])]
+            self.top_dirs = [(s - size if path.startswith(p) else s, p) for s, p in self.top_dirs if not inside(p)]
+            heapq.heapify(self.top_files)
+            heapq.heapify(self.top_dirs)
+            self.size -= size
+
+    def push(self, heap, size, path):
+        with self.lock:
+            if len(heap) < self.top:
+                heapq.heappush(heap, (size, path))
+            elif (size, path) > heap[0]:
+                heapq.heapreplace(heap, (size, path))
+
+    def walk(self):
+        try:
+            device = os.lstat(self.path).st_dev
+            stack = [[self.path, iter(list_entries(self.path)), 0]]  # path, entries, size so far
+        except OSError:
+            self.errors += 1
+            stack = []
+        while stack and not self.cancelled:
+            frame = stack[-1]
+            entry = next(frame[1], None)
+            if entry is None:  # subtree is done
+                stack.pop()
+                if stack:
+                    stack[-1][2] += frame[2]
+                    self.push(self.top_dirs, frame[2], frame[0] + os.sep)
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not self.one_filesystem or entry.stat(follow_symlinks=False).st_dev == device:
+                        stack.append([entry.path, iter(list_entries(entry.path)), 0])
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                self.errors += 1
+                continue
+            self.files += 1
+            if st.st_nlink > 1 and st.st_ino:
+                key = (st.st_dev, st.st_ino)
+                if key in self.inodes:
+                    continue
+                self.inodes.add(key)
+            frame[2] += st.st_size
+            self.size += st.st_size
+            self.push(self.top_files, st.st_size, entry.path)
+        self.finished.set()
+
+
+if not ST3:
+    plugin_loaded()
+    unload_handler = plugin_unloaded
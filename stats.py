@@ -0,0 +1,192 @@
+# coding: utf-8
+
+'''stat of files: short-living cache shared by properties popup and details mode, cache of number
+of items in directories, and pool of threads which stat (or count) many paths in background (see
+dired_misc.Details and dired_misc.ChildCounts)'''
+
+from __future__ import print_function
+import os, threading, time, fnmatch
+import sublime
+
+try:
+    import queue
+except ImportError:  # ST2
+    import Queue as queue
+
+ST3 = int(sublime.version()) >= 3000
+
+if ST3:
+    from .common import channel
+else:  # ST2 imports
+    from common import channel
+
+WORKERS = 2
+BATCH = 64           # paths per task, so workers share big requests
+TTL = 2              # seconds: result of stat is reused that long unless watcher reports change
+MAX_ENTRIES = 20000  # expired entries are dropped when there are more
+
+scandir = getattr(os, 'scandir', None)  # absent in Python 3.3 of ST3
+
+
+def plugin_loaded():
+    channel.listen(u'FileBrowserVCS', stat_cache.on_event)
+    channel.listen(u'FileBrowserVCS', count_cache.on_event)
+
+
+def plugin_unloaded():
+    channel.unlisten(u'FileBrowserVCS', stat_cache.on_event)
+    channel.unlisten(u'FileBrowserVCS', count_cache.on_event)
+    stat_pool.stop()
+
+
+class StatCache(object):
+    '''os.stat_result (or OSError) per path for TTL seconds; change reported by watcher drops path
+    and its parent (mtime of directory is changed too)'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # path without trailing separator: (timestamp, stat_result, error)
+
+    def stat(self, path):
+        '''Same as os.stat (os.lstat for broken link), raise OSError'''
+        key = path.rstrip(os.sep) or path
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None or now - entry[0] > TTL:
+            entry = (now,) + self.call(key)
+            with self.lock:
+                if len(self.entries) > MAX_ENTRIES:
+                    self.entries = dict((k, e) for k, e in self.entries.items() if now - e[0] <= TTL)
+                self.entries[key] = entry
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+    def call(self, path):
+        try:
+            return (os.stat(path), None)
+        except OSError as e:
+            try:
+                return (os.lstat(path), None)
+            except OSError:
+                return (None, e)
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event, payload is path which was changed'''
+        if event != u'changed':
+            return
+        path = payload.rstrip(os.sep)
+        with self.lock:
+            self.entries.pop(path, None)
+            self.entries.pop(os.path.dirname(path), None)
+
+
+stat_cache = StatCache()
+
+
+def stat_path(path):
+    '''Return os.stat_result or None, see StatCache.stat'''
+    try:
+        return stat_cache.stat(path)
+    except OSError:
+        return None
+
+
+class CountCache(object):
+    '''Number of items in directory, counting stops after limit (so huge directory is cheap);
+    result is valid while mtime of directory is the same'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # (path, limit, hidden patterns): (mtime, count)
+
+    def count(self, path, limit, patterns=()):
+        '''Return number of items in path which do not match patterns, limit + 1 if there are more
+        than limit, None if path cannot be listed'''
+        st = stat_path(path)
+        if st is None:
+            return None
+        key = (path.rstrip(os.sep) or path, limit, tuple(patterns))
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] == st.st_mtime:
+            return entry[1]
+        try:
+            count = self.call(path, limit, patterns)
+        except OSError:
+            return None
+        with self.lock:
+            if len(self.entries) > MAX_ENTRIES:
+                self.entries = {}
+            self.entries[key] = (st.st_mtime, count)
+        return count
+
+    def call(self, path, limit, patterns):
+        entries = scandir(path) if scandir else os.listdir(path)
+        count = 0
+        try:
+            for entry in entries:
+                name = getattr(entry, 'name', entry)
+                if not any(fnmatch.fnmatch(name, p) for p in patterns):
+                    count += 1
+                    if count > limit:
+                        break
+        finally:
+            if hasattr(entries, 'close'):
+                entries.close()
+        return count
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event, payload is path which was changed'''
+        if event != u'changed':
+            return
+        changed = os.path.dirname(payload.rstrip(os.sep))
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == changed]:
+                del self.entries[key]
+
+
+count_cache = CountCache()
+
+
+class StatPool(object):
+    '''Threads are started on the first request and live as long as the plugin'''
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, paths, callback, function=None):
+        '''callback is called on worker thread with dict {path: stat_result or None} for every
+        batch of paths; function(path) is called instead of stat if given'''
+        with self.lock:
+            if not self.threads:
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self.work)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        for i in range(0, len(paths), BATCH):
+            self.queue.put((paths[i:i + BATCH], callback, function or stat_path))
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            paths, callback, function = task
+            callback(dict((p, function(p)) for p in paths))
+
+    def stop(self):
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self.queue.put(None)
+
+
+stat_pool = StatPool()
+
+
+if not ST3:
+    plugin_loaded()
+    unload_handler = plugin_unloaded
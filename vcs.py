@@ -0,0 +1,806 @@
+# coding: utf-8
+
+'''VCS integration helpers used by CallVCS (see dired_misc):
+process-wide cache of status which is shared by all views within the same repository
+'''
+
+from __future__ import print_function
+import os, threading, time, mmap, struct, subprocess, glob
+from os.path import join, getmtime
+import sublime
+
+ST3 = int(sublime.version()) >= 3000
+
+if ST3:
+    from .common import channel
+else:  # ST2 imports
+    from common import channel
+
+MAX_AGE = 60  # seconds: cached status is not trusted longer than that, even without any signal
+MAX_TOUCHED = 64  # if more paths are changed, full status is cheaper than status of every path
+HG_TIMEOUT = 10  # seconds: stuck command server is killed, so plain hg status is used instead
+
+# files which are modified by VCS itself whenever status of repository may change
+SIGNATURE_FILES = {'git': ['.git/index', '.git/HEAD'],
+                   'hg':  ['.hg/dirstate', '.hg/branch']}
+
+
+# states of items, one item may have several states, e.g. 'AM' staged and modified afterwards
+MODIFIED, STAGED, DELETED, RENAMED, CONFLICTED, UNTRACKED, IGNORED = 'M', 'A', 'D', 'R', 'U', '?', '!'
+PRIORITY = 'UDMRA?!'  # if item has several states, the first one is displayed
+HG_STATES = {'M': MODIFIED, 'A': STAGED, 'R': DELETED, '!': DELETED, '?': UNTRACKED, 'I': IGNORED}
+
+
+def plugin_loaded():
+    channel.listen(u'FileBrowserVCS', status_cache.on_event)
+    channel.listen(u'FileBrowser', hg_servers.on_event)
+    channel.listen(u'FileBrowser', status_jobs.on_event)
+    channel.listen(u'FileBrowserVCS', ignored_cache.on_event)
+
+
+def plugin_unloaded():
+    channel.unlisten(u'FileBrowserVCS', status_cache.on_event)
+    channel.unlisten(u'FileBrowser', hg_servers.on_event)
+    channel.unlisten(u'FileBrowser', status_jobs.on_event)
+    channel.unlisten(u'FileBrowserVCS', ignored_cache.on_event)
+    hg_servers.close_all()
+    ignored_cache.close_all()
+
+
+def find_command(command):
+    '''Expand wildcards and envvars in custom command (git_path, hg_path settings)
+    Return path of executable or None if pattern matches nothing'''
+    if any(c for c in '~*?[]$%' if c in command) and not os.path.isfile(command):
+        match = glob.glob(os.path.expandvars(os.path.expanduser(command)))
+        return match[0] if match else None
+    return command
+
+
+def git_dir(root):
+    '''Return path of git directory; .git may be a file with "gitdir: path" (worktree, submodule)'''
+    dot_git = join(root, '.git')
+    if not os.path.isfile(dot_git):
+        return dot_git
+    try:
+        with open(dot_git) as f:
+            line = f.readline().strip()
+    except (IOError, OSError):
+        return dot_git
+    if not line.startswith('gitdir:'):
+        return dot_git
+    return os.path.normpath(join(root, line[len('gitdir:'):].strip()))
+
+
+def signature(vcs, root):
+    '''Return tuple of mtimes of SIGNATURE_FILES'''
+    mtimes = []
+    for name in SIGNATURE_FILES[vcs]:
+        if vcs == 'git':
+            name = join(git_dir(root), *name.split('/')[1:])
+        else:
+            name = join(root, *name.split('/'))
+        try:
+            mtimes.append(getmtime(name))
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def find_root(vcs, path, known=None):
+    '''Walk up from path looking for .git (directory or file) or .hg directory
+    known
+        dict {directory: root}, already memoized results; updated with results for all visited
+        directories
+    Return root or empty string if path is not in repository'''
+    marker = '.%s' % vcs
+    known = {} if known is None else known
+    visited = []
+    directory = os.path.normpath(path)
+    root = ''
+    while True:
+        if directory in known:
+            root = known[directory]
+            break
+        visited.append(directory)
+        candidate = join(directory, marker)
+        if os.path.isdir(candidate) or (vcs == 'git' and os.path.isfile(candidate)):
+            root = directory
+            break
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+    for d in visited:
+        known[d] = root
+    return root
+
+
+def dominant(states):
+    '''Return state which shall be displayed for string of states'''
+    return next((c for c in PRIORITY if c in states), '')
+
+
+def parse_git_status(output, root):
+    '''Parse output of git status --porcelain=v2 -z
+    Return dict {fullpath: states}, untracked directory (if untracked files are not enumerated)
+    has trailing separator in git output, but not in returned path
+    '''
+    changed = {}
+    records = iter(output.split('\x00'))
+    for record in records:
+        if not record or record[0] == '#':
+            continue
+        kind = record[0]
+        if kind in '?!':
+            path, states = record[2:], UNTRACKED if kind == '?' else IGNORED
+        elif kind in '12u':
+            fields = record.split(' ', {'1': 8, '2': 9, 'u': 10}[kind])
+            path, xy = fields[~0], fields[1]
+            if kind == 'u':
+                states = CONFLICTED
+            else:
+                states = ''
+                if kind == '2':
+                    states += RENAMED
+                    next(records, None)  # original path of renamed item
+                if DELETED in xy:
+                    states += DELETED
+                elif xy[0] != '.' and kind == '1':
+                    states += STAGED
+                if xy[1] in 'MT':
+                    states += MODIFIED
+        else:
+            continue
+        changed[os.path.normpath(join(root, path))] = states
+    return changed
+
+
+def parse_hg_status(output, root):
+    '''Parse output of hg status, return dict {fullpath: states}'''
+    changed = {}
+    for line in output.split('\n'):
+        state = HG_STATES.get(line[:1])
+        if state and line[2:]:
+            changed[os.path.normpath(join(root, line[2:]))] = state
+    return changed
+
+
+def rollup(changed, root):
+    '''Return dict {directory: states} where states are union of states of all items within
+    directory (except ignored); computed in one pass over trie of changed paths
+    '''
+    trie = {}  # name: [states, children]
+    root = os.path.normpath(root)
+    for path, states in changed.items():
+        rel = os.path.relpath(path, root)
+        if rel == '.':
+            continue
+        node = [None, trie]
+        for part in rel.split(os.sep):
+            node = node[1].setdefault(part, ['', {}])
+        node[0] += states.replace(IGNORED, '')
+
+    rolled = {}
+
+    def walk(path, node):
+        states, children = node
+        for name, child in children.items():
+            states += walk(join(path, name), child)
+        states = ''.join(c for c in PRIORITY if c in states)
+        if children and states:
+            rolled[path] = states
+        return states
+
+    for name, node in trie.items():
+        walk(join(root, name), node)
+    return rolled
+
+
+class GitIndexError(Exception):
+    pass
+
+
+ENTRY = struct.Struct('>10I20sH')  # ctime, ctime_ns, mtime, mtime_ns, dev, ino, mode, uid, gid, size, sha, flags
+
+
+def read_git_index(index_path, wanted):
+    '''Stream entries of git index file (versions 2, 3 and 4) through mmap without reading the
+    whole file into memory
+    wanted
+        set of paths relative to root with forward slashes (as bytes, utf-8); entries are sorted
+        by path, so parsing stops after the last wanted path
+    Return dict {path: (mtime, mtime_ns, size, mode, stage, skip)} for wanted paths found in index,
+    where skip is True if entry is marked assume-valid or skip-worktree
+    Raise GitIndexError if file cannot be parsed
+    '''
+    if not wanted:
+        return {}
+    last = max(wanted)
+    found = {}
+    with open(index_path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            raise GitIndexError('empty index')
+    try:
+        if mm[:4] != b'DIRC':
+            raise GitIndexError('not an index file')
+        version, count = struct.unpack('>II', mm[4:12])
+        if version not in (2, 3, 4):
+            raise GitIndexError('unsupported index version %d' % version)
+        pos, path = 12, b''
+        for _ in range(count):
+            fields = ENTRY.unpack_from(mm, pos)
+            flags = fields[11]
+            start, pos = pos, pos + ENTRY.size
+            extended = 0
+            if version >= 3 and flags & 0x4000:
+                extended = struct.unpack_from('>H', mm, pos)[0]
+                pos += 2
+            if version == 4:
+                # path is prefix compressed: varint of bytes to strip from previous path, then suffix
+                byte = mm[pos] if ST3 else ord(mm[pos])
+                pos += 1
+                strip = byte & 0x7f
+                while byte & 0x80:
+                    byte = mm[pos] if ST3 else ord(mm[pos])
+                    pos += 1
+                    strip = ((strip + 1) << 7) | (byte & 0x7f)
+                end = mm.find(b'\x00', pos)
+                path = path[:len(path) - strip] + mm[pos:end]
+                pos = end + 1
+            else:
+                end = mm.find(b'\x00', pos)
+                path = mm[pos:end]
+                # entry is padded with 1-8 NUL bytes to multiple of 8
+                pos = start + ((end - start + 8) & ~7)
+            if end < 0:
+                raise GitIndexError('truncated index')
+            if path in wanted:
+                stage = (flags >> 12) & 3
+                skip = bool(flags & 0x8000 or extended & 0x4000)
+                found[path] = (fields[2], fields[3], fields[9], fields[6], stage, skip)
+            elif path > last:
+                break
+    finally:
+        mm.close()
+    return found
+
+
+def index_states(root, paths):
+    '''Compare files with their entries in .git/index without spawning git
+    paths
+        list of full paths of files (e.g. visible rows of view)
+    Return tuple of two elements
+        changed    dict {fullpath: states} for items which are definitely modified or conflicted
+        ambiguous  list of full paths which must be checked by real git status: not in index
+                   (untracked or ignored), same size but different mtime, racily clean
+    Only worktree modifications are detected; staged changes require comparison with HEAD
+    Raise GitIndexError (or OSError) if index cannot be read
+    '''
+    index_path = join(git_dir(root), 'index')
+    index_mtime = os.stat(index_path).st_mtime
+    rel = {}
+    for p in paths:
+        r = os.path.relpath(p, root).replace(os.sep, '/')
+        rel[r if isinstance(r, bytes) else r.encode('utf-8')] = p
+    entries = read_git_index(index_path, set(rel))
+    changed, ambiguous = {}, []
+    for r, p in rel.items():
+        entry = entries.get(r)
+        if entry is None:
+            ambiguous.append(p)
+            continue
+        mtime, mtime_ns, size, mode, stage, skip = entry
+        if stage:
+            changed[p] = CONFLICTED
+            continue
+        if skip:
+            continue
+        try:
+            st = os.lstat(p)
+        except OSError:
+            changed[p] = DELETED
+            continue
+        st_ns = getattr(st, 'st_mtime_ns', None)
+        st_ns = (st_ns % 10**9) if st_ns is not None else int((st.st_mtime % 1) * 10**9)
+        if (st.st_size & 0xffffffff) != size:
+            changed[p] = MODIFIED
+        elif int(st.st_mtime) != mtime or (mtime_ns and st_ns != mtime_ns) or (st.st_mode & 0o111) != (mode & 0o111):
+            ambiguous.append(p)  # content may be the same
+        elif st.st_mtime >= index_mtime:
+            ambiguous.append(p)  # racily clean: modified in the same second index was written
+    return changed, ambiguous
+
+
+class StatusCache(object):
+    '''Status of repositories keyed by (vcs, root, pathspec, untracked), see CallVCS.scope
+    Entry is valid while
+        • mtimes of SIGNATURE_FILES are the same,
+        • watcher did not report any change which requires full status (see on_event),
+        • it is younger than MAX_AGE,
+        • explicit refresh did not forget it (see forget), it is used by auto-refresh and expand.
+    Also memoize roots of directories (invalidated by watcher when .git or .hg is created or
+    removed), so unchanged repository does not require any process at all.
+    All methods are called from worker threads, hence lock.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # (vcs, root, pathspec, untracked): (signature, timestamp, value, touched)
+        self.roots = {}    # vcs: {directory: root or empty string if directory is not in repository}
+
+    def get_root(self, vcs, path):
+        '''Return root of repository or empty string, no process is spawned, see find_root'''
+        with self.lock:
+            known = self.roots.setdefault(vcs, {})
+            return find_root(vcs, path, known)
+
+    def get(self, vcs, root, scope):
+        '''Return tuple (scope of entry, cached value, touched) or None if there is no valid entry
+        scope is tuple (pathspec, untracked), see CallVCS.scope; entry for the same untracked mode
+        and for pathspec of ancestor directory (or whole repository) is suitable as well
+        touched is frozenset of paths changed since status was taken, see on_event and update'''
+        pathspec, untracked = scope
+        with self.lock:
+            candidates = [(k, e[:3] + (frozenset(e[3]),)) for k, e in self.entries.items()
+                          if k[:2] == (vcs, root) and k[3] == untracked and
+                          (not k[2] or k[2] == pathspec or pathspec.startswith(k[2] + os.sep))]
+        sign = None
+        for key, (entry_sign, timestamp, value, touched) in candidates:
+            if time.time() - timestamp > MAX_AGE:
+                continue
+            sign = sign or signature(vcs, root)
+            if entry_sign == sign:
+                return (key[2:], value, touched)
+        return None
+
+    def put(self, vcs, root, scope, value):
+        '''signature is taken after status is finished because status itself may update
+        .git/index (or .hg/dirstate)'''
+        with self.lock:
+            self.entries[(vcs, root) + tuple(scope)] = (signature(vcs, root), time.time(), value, set())
+
+    def forget(self, vcs, root, scope):
+        '''Drop entries which overlap with scope, so explicit refresh takes status anew: watcher
+        does not see changes in collapsed directories'''
+        pathspec = scope[0]
+        def overlaps(other):
+            return (not pathspec or not other or other == pathspec or
+                    pathspec.startswith(other + os.sep) or other.startswith(pathspec + os.sep))
+        with self.lock:
+            for key in [k for k in self.entries if k[:2] == (vcs, root) and overlaps(k[2])]:
+                del self.entries[key]
+
+    def update(self, vcs, root, scope, touched, value):
+        '''Replace value of entry after status of touched paths was merged into it'''
+        key = (vcs, root) + tuple(scope)
+        with self.lock:
+            if key in self.entries:
+                sign, timestamp, _, pending = self.entries[key]
+                self.entries[key] = (sign, timestamp, value, pending - touched)
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event, called on watchdog thread; payload is path which
+        was changed:
+            • in git worktree it is remembered as touched, so only status of touched paths is
+              asked next time (unless there are too many of them);
+            • changes of .git/index and .git/HEAD are detected by signature anyway;
+            • change of .gitignore or anything in hg repository invalidates entries.
+        '''
+        if event != u'changed':
+            return
+        path = payload.rstrip(os.sep)
+        with self.lock:
+            for key in [k for k in self.entries if path.startswith(k[1].rstrip(os.sep) + os.sep)]:
+                vcs, root, pathspec = key[:3]
+                rel = path[len(root.rstrip(os.sep)) + 1:]
+                if vcs != 'git' or os.path.basename(rel) == '.gitignore':
+                    del self.entries[key]
+                elif rel == '.git' or rel.startswith('.git' + os.sep):
+                    continue
+                elif pathspec and not (rel == pathspec or rel.startswith(pathspec + os.sep)):
+                    continue  # outside of status scope
+                elif len(self.entries[key][3]) >= MAX_TOUCHED:
+                    del self.entries[key]
+                else:
+                    self.entries[key][3].add(path)
+            if os.path.basename(payload.rstrip(os.sep)) in ('.git', '.hg'):
+                # repository was created or removed, forget roots of its directories
+                parent = os.path.dirname(payload.rstrip(os.sep))
+                for known in self.roots.values():
+                    for d in [d for d in known if d == parent or d.startswith(parent + os.sep)]:
+                        del known[d]
+
+
+status_cache = StatusCache()
+
+
+class StatusJobs(object):
+    '''Bookkeeping of status processes
+    every CallVCS gets generation for its view, result of older generation is ignored and its
+    process is killed; at most one status runs per repository, requests which were waiting for
+    it are coalesced via status_cache, see CallVCS.check
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.generations = {}  # view id: generation of the latest CallVCS
+        self.processes = {}    # view id: list of Popen objects running on behalf of view
+        self.repos = {}        # (vcs, root): Lock
+
+    def next_generation(self, view_id):
+        '''Return new generation for view, kill processes of previous one'''
+        with self.lock:
+            generation = self.generations[view_id] = self.generations.get(view_id, 0) + 1
+            processes = self.processes.pop(view_id, [])
+        for process in processes:
+            kill(process)
+        return generation
+
+    def is_current(self, view_id, generation):
+        return self.generations.get(view_id) == generation
+
+    def repo_lock(self, vcs, root):
+        with self.lock:
+            return self.repos.setdefault((vcs, root), threading.Lock())
+
+    def started(self, view_id, generation, process):
+        '''Register process; return False (and kill it) if generation is already stale'''
+        with self.lock:
+            if self.generations.get(view_id) == generation:
+                self.processes.setdefault(view_id, []).append(process)
+                return True
+        kill(process)
+        return False
+
+    def finished(self, view_id, process):
+        with self.lock:
+            processes = self.processes.get(view_id, [])
+            if process in processes:
+                processes.remove(process)
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event'''
+        if event == u'view_closed':
+            self.next_generation(payload)
+            with self.lock:
+                del self.generations[payload]
+
+
+def kill(process):
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass  # already finished
+
+
+status_jobs = StatusJobs()
+
+
+class CheckIgnore(object):
+    '''Persistent `git check-ignore --stdin -z --non-matching -v` process for one repository;
+    git flushes answer for every path, so paths are written and answers are read in batches
+    (not all at once, otherwise both sides may block on full pipes)
+    '''
+    BATCH = 256
+
+    def __init__(self, command, root):
+        self.command = command
+        self.root = root
+        self.process = None
+        self.devnull = None
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+
+    def start(self):
+        startupinfo = None
+        if os.name == 'nt':
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        # stderr is never read, pipe would fill up and block git
+        self.devnull = getattr(subprocess, 'DEVNULL', None) or open(os.devnull, 'wb')
+        self.process = subprocess.Popen(
+            [self.command, 'check-ignore', '--stdin', '-z', '--non-matching', '-v'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.devnull,
+            cwd=self.root, env=dict(os.environ, GIT_FLUSH='1'), startupinfo=startupinfo)
+
+    def check(self, paths):
+        '''paths is list of paths relative to root; return list of booleans'''
+        with self.lock:
+            self.last_used = time.time()
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+            result = []
+            for i in range(0, len(paths), self.BATCH):
+                result.extend(self.check_batch(paths[i:i + self.BATCH]))
+            return result
+
+    def check_batch(self, paths):
+        data = b''.join(p.replace(os.sep, '/').encode('utf-8') + b'\x00' for p in paths)
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+        # every answer is four fields: source, line number, pattern, path
+        fields, rest = [], b''
+        fd = self.process.stdout.fileno()
+        while len(fields) < 4 * len(paths):
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise IOError('git check-ignore died')
+            parts = (rest + chunk).split(b'\x00')
+            fields.extend(parts[:-1])
+            rest = parts[-1]
+        # matched negated pattern (e.g. "!keep.log") means file is not ignored
+        return [bool(fields[i]) and not fields[i + 2].startswith(b'!') for i in range(0, len(fields), 4)]
+
+    def close(self):
+        process, self.process = self.process, None
+        if process is not None:
+            try:
+                process.stdin.close()
+                process.stdout.close()
+                if self.devnull not in (None, getattr(subprocess, 'DEVNULL', None)):
+                    self.devnull.close()
+            except (IOError, OSError):
+                pass
+            kill(process)
+
+
+class IgnoredCache(object):
+    '''Which items are ignored by git, cached per directory (at most MAX_DIRS, least recently used
+    is dropped); one CheckIgnore per repository (at most MAX_PROCESSES, least recently used is
+    closed); cache of directory is dropped and process of repository is restarted when .gitignore
+    in it (or above it) is changed. Failure of check-ignore (e.g. directory is inside submodule) is
+    remembered for directory as well, so it does not spawn new process on every refresh'''
+    MAX_PROCESSES = 8
+    MAX_DIRS = 256
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = {}  # root: CheckIgnore
+        self.dirs = {}       # directory: [last used, {name: boolean} or None if check-ignore failed]
+
+    def ignored(self, command, root, directory, names):
+        '''Return set of names in directory which are ignored; every name is asked only once'''
+        directory = os.path.normpath(directory)
+        with self.lock:
+            entry = self.dirs.get(directory)
+            if entry is not None:
+                entry[0] = time.time()
+                if entry[1] is None:
+                    return set()
+            known = dict(entry[1]) if entry is not None else {}
+            checker = self.processes.get(root)
+            if checker is None or checker.command != command:
+                if checker:
+                    checker.close()
+                checker = self.processes[root] = CheckIgnore(command, root)
+                unused = sorted(self.processes.values(), key=lambda c: c.last_used)[:-self.MAX_PROCESSES]
+                for c in unused:
+                    del self.processes[c.root]
+                    c.close()
+        missing = [n for n in names if n not in known]
+        if missing:
+            try:
+                answers = checker.check([os.path.relpath(join(directory, n), root) for n in missing])
+            except (IOError, OSError):
+                checker.close()
+                answers = None
+            with self.lock:
+                entry = self.dirs.setdefault(directory, [time.time(), {}])
+                if answers is None:
+                    entry[1] = None
+                elif entry[1] is not None:
+                    entry[1].update(zip(missing, answers))
+                while len(self.dirs) > self.MAX_DIRS:
+                    del self.dirs[min(self.dirs, key=lambda d: self.dirs[d][0])]
+            if answers is None:
+                return set()
+            known.update(zip(missing, answers))
+        return set(n for n in names if known.get(n))
+
+    def known(self, directory, names):
+        '''Return set of names in directory which are known to be ignored, no process is spawned,
+        so it can be called on main thread'''
+        with self.lock:
+            entry = self.dirs.get(os.path.normpath(directory))
+            answers = entry[1] if entry is not None else None
+            return set(n for n in names if answers and answers.get(n))
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event, payload is path which was changed'''
+        if event != u'changed':
+            return
+        parent, name = os.path.split(payload.rstrip(os.sep))
+        if name == 'exclude' and parent.endswith(join('.git', 'info')):
+            parent = os.path.dirname(os.path.dirname(parent))  # affects whole repository
+        elif name != '.gitignore':
+            return
+        with self.lock:
+            for d in [d for d in self.dirs if d == parent or d.startswith(parent + os.sep)]:
+                del self.dirs[d]
+            # running check-ignore keeps rules it has loaded, so next query starts new process
+            stale = [r for r in self.processes if parent == r or parent.startswith(r + os.sep)]
+            checkers = [self.processes.pop(r) for r in stale]
+        for checker in checkers:
+            checker.close()
+
+    def close_all(self):
+        with self.lock:
+            processes, self.processes, self.dirs = list(self.processes.values()), {}, {}
+        for checker in processes:
+            checker.close()
+
+
+ignored_cache = IgnoredCache()
+
+
+class HgServerError(Exception):
+    pass
+
+
+class HgServer(object):
+    '''Persistent `hg serve --cmdserver pipe` process for one repository, so every status does not
+    pay startup of Python interpreter and extensions of hg
+    Protocol: server writes messages as 1-byte channel, 4-byte big-endian length and data; client
+    sends "runcommand" line, 4-byte length and arguments separated by NUL; command is finished when
+    message on channel "r" (return code) arrives
+    Reads block, so every run is guarded by timer which kills server after HG_TIMEOUT.
+    '''
+    def __init__(self, command, root):
+        self.command = command
+        self.root = root
+        self.process = None
+        self.devnull = None
+        self.lock = threading.RLock()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        env = dict(os.environ, HGPLAIN='1', HGENCODING='UTF-8')
+        startupinfo = None
+        if os.name == 'nt':
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        # stderr is never read, pipe would fill up with warnings and block server
+        self.devnull = getattr(subprocess, 'DEVNULL', None) or open(os.devnull, 'wb')
+        try:
+            self.process = subprocess.Popen(
+                [self.command, 'serve', '--cmdserver', 'pipe', '--config', 'ui.interactive=False'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.devnull,
+                cwd=self.root, env=env, startupinfo=startupinfo)
+        except OSError as e:
+            raise HgServerError(str(e))
+        channel_name, hello = self.read_message()  # capabilities and encoding
+        if channel_name != b'o' or b'runcommand' not in hello:
+            self.close()
+            raise HgServerError('unexpected hello: %r' % hello)
+
+    def read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise HgServerError('server died')
+        return data
+
+    def read_message(self):
+        channel_name = self.read(1)
+        length = struct.unpack('>I', self.read(4))[0]
+        if channel_name in (b'I', b'L'):
+            return channel_name, length  # server asks for input, length is maximal size
+        return channel_name, self.read(length)
+
+    def runcommand(self, args):
+        '''Return output (bytes) of hg command, args is list of unicode objects'''
+        data = b'\x00'.join(a.encode('utf-8') for a in args)
+        self.process.stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+        self.process.stdin.flush()
+        output = []
+        while True:
+            channel_name, data = self.read_message()
+            if channel_name == b'o':
+                output.append(data)
+            elif channel_name == b'r':
+                return b''.join(output)
+            elif channel_name in (b'I', b'L'):
+                # no input, it is equal to EOF for the command
+                self.process.stdin.write(struct.pack('>I', 0))
+                self.process.stdin.flush()
+            elif channel_name.isupper():
+                raise HgServerError('unsupported required channel %r' % channel_name)
+            # other channels (e.g. "e" for errors, "d" for debug) are ignored
+
+    def run(self, args):
+        '''Run command, (re)start server if needed; retry once if server died in the middle, but
+        not if it was stuck'''
+        with self.lock:
+            for attempt in (0, 1):
+                expired = []
+                timer = threading.Timer(HG_TIMEOUT, self.expire, (expired,))
+                timer.daemon = True
+                timer.start()
+                try:
+                    if not self.alive():
+                        self.start()
+                    return self.runcommand(args)
+                except (HgServerError, IOError, OSError) as e:
+                    self.close()
+                    if attempt or expired:
+                        raise HgServerError('timed out' if expired else str(e))
+                finally:
+                    timer.cancel()
+
+    def expire(self, expired):
+        '''Called by timer thread; killed server makes blocked read fail'''
+        expired.append(True)
+        process = self.process
+        if process is not None:
+            kill(process)
+
+    def close(self):
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()  # server exits on EOF
+            process.stdout.close()
+            if self.devnull not in (None, getattr(subprocess, 'DEVNULL', None)):
+                self.devnull.close()
+        except (IOError, OSError):
+            pass
+        if process.poll() is None:
+            try:
+                process.terminate()
+            except OSError:
+                pass
+
+
+class HgServers(object):
+    '''Registry of HgServer per root; server lives while there is a view which uses its repository'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.servers = {}  # root: HgServer
+        self.users = {}    # view id: root
+
+    def run(self, view_id, command, root, args):
+        '''Return output (bytes) of hg command executed in root
+        Raise HgServerError if command server cannot be used'''
+        with self.lock:
+            server = self.servers.get(root)
+            if server is None or server.command != command:
+                if server:
+                    server.close()
+                server = self.servers[root] = HgServer(command, root)
+        self.use(view_id, root)
+        return server.run(args)
+
+    def use(self, view_id, root):
+        '''Remember repository used by view (empty root means none), close servers without views'''
+        with self.lock:
+            if root:
+                self.users[view_id] = root
+            else:
+                self.users.pop(view_id, None)
+            used = set(self.users.values())
+            unused = [r for r in self.servers if r not in used]
+            servers = [self.servers.pop(r) for r in unused]
+        for server in servers:
+            server.close()
+
+    def on_event(self, package, event, payload):
+        '''Receiving args from common.emit_event'''
+        if event == u'view_closed':
+            self.use(payload, '')
+
+    def close_all(self):
+        with self.lock:
+            servers, self.servers, self.users = list(self.servers.values()), {}, {}
+        for server in servers:
+            server.close()
+
+
+hg_servers = HgServers()
+
+
+if not ST3:
+    plugin_loaded()
+    unload_handler = plugin_unloaded